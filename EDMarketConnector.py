@@ -7,6 +7,7 @@ from collections import OrderedDict
 from functools import partial
 import json
 import keyring
+import multiprocessing
 from os import chdir, mkdir, environ
 from os.path import dirname, expanduser, isdir, join
 import re
@@ -28,7 +29,7 @@ if getattr(sys, 'frozen', False):
 
     # By default py2exe tries to write log to dirname(sys.executable) which fails when installed
     import tempfile
-    sys.stdout = sys.stderr = open(join(tempfile.gettempdir(), '%s.log' % appname), 'wt', 0)	# unbuffered
+    sys.stdout = sys.stderr = open(join(tempfile.gettempdir(), '%s.log' % appname), '--multiprocessing-fork' in sys.argv and 'at' or 'wt', 0)	# unbuffered. Plugin host processes append.
     print '%s %s %s' % (applongname, appversion, strftime('%Y-%m-%dT%H:%M:%S', localtime()))
 
 import Tkinter as tk
@@ -53,6 +54,7 @@ from commodity import COMMODITY_CSV
 import td
 import eddn
 import edsm
+import journaldb
 import coriolis
 import eddb
 import edshipyard
@@ -67,7 +69,9 @@ from theme import theme
 EDDB = eddb.EDDB()
 
 SERVER_RETRY = 5	# retry pause for Companion servers [s]
-EDSM_POLL = 0.1
+PLUGIN_POLL = 1	# check on plugins running in the background [s]
+JOURNAL_BATCH = 50	# Max journal entries to handle per <<JournalEvent>>
+JOURNAL_SLICE = 0.1	# Max time to spend handling journal entries before letting Tk process other events [s]
 
 
 class AppWindow:
@@ -83,8 +87,9 @@ class AppWindow:
 
         self.holdofftime = config.getint('querytime') + companion.holdoff
         self.session = companion.Session()
-        self.edsm = edsm.EDSM()
+        self.edsm = edsm.EDSM(self, EDDB.system_ids)	# Systems in EDDB have known coordinates
         self.eddn = eddn.EDDN(self)
+        self.journaldb = config.getint('journaldb') and journaldb.JournalDB() or None	# Optional index of historical journal entries
 
         self.w = master
         self.w.title(applongname)
@@ -285,6 +290,8 @@ class AppWindow:
         self.w.bind('<KP_Enter>', self.getandsend)
         self.w.bind_all('<<Invoke>>', self.getandsend)		# Hotkey monitoring
         self.w.bind_all('<<JournalEvent>>', self.journal_event)	# Journal monitoring
+        self.w.bind_all('<<EDDNStatus>>', self.eddn_status)	# Progress sending to EDDN
+        self.w.bind_all('<<EDSMStatus>>', self.edsm_status)	# Results from EDSM
         self.w.bind_all('<<Quit>>', self.onexit)		# Updater
 
         # Load updater after UI creation (for WinSparkle)
@@ -316,6 +323,10 @@ class AppWindow:
         if not self.eddn.load():
             self.status['text'] = 'Error: Is another copy of this app already running?'	# Shouldn't happen - don't bother localizing
 
+        if plug.PLUGIN_THREADS:
+            self.plugin_status = None
+            self.plugpoll()
+
     # callback after the Preferences dialog is applied
     def postprefs(self, dologin=True):
         self.set_labels()	# in case language has changed
@@ -326,6 +337,8 @@ class AppWindow:
         # (Re-)install log monitoring
         if not monitor.start(self.w):
             self.status['text'] = 'Error: Check %s' % _('E:D journal file location')	# Location of the new Journal file in E:D 2.2
+        elif self.journaldb:
+            self.journaldb.start(monitor.currentdir)
         if dologin:
             self.login()	# Login if not already logged in with this Cmdr
 
@@ -457,6 +470,7 @@ class AppWindow:
                     self.ship['text'] = companion.ship_map.get(data['ship']['name'].lower(), data['ship']['name'])
                     monitor.state['ShipID'] =   data['ship']['id']
                     monitor.state['ShipType'] = data['ship']['name'].lower()
+                    monitor.state_changed()
                 if not monitor.system:
                     self.system['text'] = data['lastSystem']['name']
                     self.system['image'] = ''
@@ -469,16 +483,6 @@ class AppWindow:
                 if config.getint('output') & config.OUT_SHIP:
                     loadout.export(data)
 
-                # Send flightlog EDSM if FSDJump failed to do so
-                if config.getint('output') & config.OUT_SYS_EDSM and self.edsm.result['img'] == self.edsm._IMG_ERROR and not monitor.is_beta and not monitor.captain and config.get('cmdrs') and monitor.cmdr in config.get('cmdrs') and config.get('edsm_usernames')[config.get('cmdrs').index(monitor.cmdr)]:
-                    try:
-                        self.edsm.writelog(querytime, monitor.system, monitor.coordinates, monitor.state['ShipID'])
-                    except Exception as e:
-                        if __debug__: print_exc()
-                        self.status['text'] = unicode(e)
-                        play_bad = True
-                    self.edsmpoll()
-
                 if not (config.getint('output') & ~config.OUT_SHIP & config.OUT_STATION_ANY):
                     # no station data requested - we're done
                     pass
@@ -535,12 +539,15 @@ class AppWindow:
                     # Update credits and ship info and send to EDSM
                     if config.getint('output') & config.OUT_SYS_EDSM:
                         try:
+                            edsm_cmdr = not monitor.is_beta and config.get('cmdrs') and monitor.cmdr in config.get('cmdrs') and config.get('edsm_usernames')[config.get('cmdrs').index(monitor.cmdr)]	# Has EDSM credentials
                             if data['commander'].get('credits') is not None:
                                 monitor.state['Credits'] = data['commander']['credits']
                                 monitor.state['Loan'] = data['commander'].get('debt', 0)
-                                self.edsm.setcredits(monitor.state['Credits'], monitor.state['Loan'])
+                                monitor.state_changed()
+                                if edsm_cmdr:
+                                    self.edsm.setcredits(monitor.state['Credits'], monitor.state['Loan'])
                             ship = companion.ship(data)
-                            if ship != self.edsm.lastship:
+                            if edsm_cmdr and ship != self.edsm.lastship:
                                 self.edsm.updateship(monitor.state['ShipID'],
                                                      monitor.state['ShipType'],
                                                      [
@@ -608,10 +615,11 @@ class AppWindow:
                 'FlightCon':  _('Helm'),	# Multicrew role
             }.get(role, role)
 
-        while True:
-            entry = monitor.get_entry()
-            if not entry:
-                return
+        if self.journaldb:
+            self.journaldb.notify(monitor.logfile)
+
+        batch = []	# Entries sent to plugins, for plugins that want them all at once
+        for entry in monitor.get_entries(JOURNAL_BATCH, time() + JOURNAL_SLICE):
 
             system_changed  = monitor.system  and self.system['text']  != monitor.system
             station_changed = monitor.station and self.station['text'] != monitor.station
@@ -632,7 +640,7 @@ class AppWindow:
             if self.system['text'] != monitor.system:
                 self.system['text'] = monitor.system or ''
                 self.edsm.link(monitor.system)
-                self.edsmpoll()
+                self.edsm_status()
             if entry['event'] in ['Undocked', 'StartJump', 'SetUserShipName', 'ShipyardBuy', 'ShipyardSell', 'ShipyardSwap', 'ModuleBuy', 'ModuleSell', 'MaterialCollected', 'MaterialDiscarded', 'ScientificResearch', 'EngineerCraft', 'Synthesis', 'JoinACrew']:
                 self.status['text'] = ''	# Periodically clear any old error
             self.w.update_idletasks()
@@ -674,6 +682,12 @@ class AppWindow:
                     if entry['event'] in ['ModuleBuy', 'ModuleSell'] and entry['Slot'] == 'PaintJob':
                         self.edsm.updateship(monitor.state['ShipID'], monitor.state['ShipType'], [('paintJob', monitor.state['PaintJob'])])
 
+                    # Look up the next system in advance
+                    if entry['event'] == 'FSDTarget':
+                        self.edsm.prefetch([entry.get('Name')])
+                    elif entry['event'] == 'StartJump' and entry.get('JumpType') == 'Hyperspace':
+                        self.edsm.prefetch([entry.get('StarSystem')])
+
                     # Write EDSM log on change
                     if monitor.mode and entry['event'] in ['Location', 'FSDJump']:
                         self.edsm.writelog(timegm(strptime(entry['timestamp'], '%Y-%m-%dT%H:%M:%SZ')), monitor.system, monitor.coordinates, monitor.state['ShipID'])
@@ -683,7 +697,7 @@ class AppWindow:
                     self.status['text'] = unicode(e)
                     if not config.getint('hotkey_mute'):
                         hotkeymgr.play_bad()
-            self.edsmpoll()
+            self.edsm_status()
 
             # Companion login - do this after EDSM so any EDSM errors don't mask login errors
             if entry['event'] in [None, 'StartUp', 'NewCommander', 'LoadGame'] and monitor.cmdr and not monitor.is_beta:
@@ -698,14 +712,16 @@ class AppWindow:
                     prefs.PreferencesDialog(self.w, self.postprefs)	# First run or failed migration
 
             if not entry['event'] or not monitor.mode:
-                return	# Startup or in CQC
+                continue	# Startup or in CQC
 
             # Plugins
-            plug.notify_journal_entry(monitor.cmdr, monitor.system, monitor.station, entry, monitor.state)
+            plug.notify_journal_entry(monitor.cmdr, monitor.system, monitor.station, entry, monitor.get_state())
+            if plug.JOURNAL_BATCH:
+                batch.append(dict(entry))	# entry may be modified below
 
             # Don't send to EDDN while on crew
             if monitor.captain:
-                return
+                continue
 
             # Plugin backwards compatibility
             if system_changed:
@@ -752,10 +768,7 @@ class AppWindow:
                         ('prohibited' , entry.get('IllegalGoods', False)),
                     ])
 
-                    self.status['text'] = _('Sending data to EDDN...')
-                    self.w.update_idletasks()
                     self.eddn.export_blackmarket(monitor.cmdr, monitor.is_beta, msg)
-                    self.status['text'] = ''
 
             except requests.exceptions.RequestException as e:
                 if __debug__: print_exc()
@@ -769,13 +782,35 @@ class AppWindow:
                 if not config.getint('hotkey_mute'):
                     hotkeymgr.play_bad()
 
+        if batch:
+            plug.notify_journal_entries(monitor.cmdr, monitor.system, monitor.station, batch, monitor.get_state())
+
+        if monitor.event_queue:
+            self.w.event_generate('<<JournalEvent>>', when="tail")	# Come back for the rest after handling other events
+
+    def eddn_status(self, event=None):
+        status = self.eddn.status()
+        if status or self.status['text'].startswith(_('Sending data to EDDN...').replace('...','')) or self.status['text'] == _("Error: Can't connect to EDDN"):
+            self.status['text'] = status	# Don't clear unrelated messages
 
-    def edsmpoll(self):
+    def edsm_status(self, event=None):
         result = self.edsm.result
         if result['done']:
             self.system['image'] = result['img']
-        else:
-            self.w.after(int(EDSM_POLL * 1000), self.edsmpoll)
+        error = self.edsm.get_error()
+        if error:
+            self.status['text'] = error
+            if not config.getint('hotkey_mute'):
+                hotkeymgr.play_bad()
+
+    # Report problems with plugins running in the background
+    def plugpoll(self):
+        status = plug.get_status()
+        if status != self.plugin_status:
+            self.plugin_status = status
+            if status:
+                self.status['text'] = status
+        self.w.after(int(PLUGIN_POLL * 1000), self.plugpoll)
 
     def shipyard_url(self, shipname=None):
 
@@ -881,7 +916,10 @@ class AppWindow:
         self.w.withdraw()	# Following items can take a few seconds, so hide the main window while they happen
         hotkeymgr.unregister()
         monitor.close()
+        if self.journaldb:
+            self.journaldb.close()
         self.eddn.close()
+        self.edsm.close()
         self.updater.close()
         self.session.close()
         config.close()
@@ -923,6 +961,8 @@ class AppWindow:
 # Run the app
 if __name__ == "__main__":
 
+    multiprocessing.freeze_support()	# For plugin host processes under py2exe
+
     # Ensure only one copy of the app is running under this user account. OSX does this automatically. Linux TODO.
     if platform == 'win32':
         import ctypes
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#
+# Rebuild Cmdr state and per-file statistics from an archive of journal files, using all available cores.
+#
+
+import argparse
+from collections import Counter
+import json
+import multiprocessing
+from os import listdir
+from os.path import basename, isdir, join
+import sys
+
+from config import config
+from monitor import EDLogs
+
+
+# Parse one journal file from scratch. Runs in a worker process, so returns only picklable data.
+def parse_file(path):
+    monitor = EDLogs()
+    summary = {
+        'file'    : basename(path),
+        'cmdr'    : None,
+        'first'   : None,	# timestamp of first entry
+        'last'    : None,	# timestamp of last entry
+        'lines'   : 0,
+        'invalid' : 0,
+        'events'  : Counter(),
+    }
+    with open(path, 'rb') as h:
+        for line in h:
+            summary['lines'] += 1
+            entry = monitor.parse_entry(line)
+            if not entry['event']:
+                summary['invalid'] += 1
+                continue
+            summary['events'][entry['event']] += 1
+            summary['first'] = summary['first'] or entry['timestamp']
+            summary['last'] = entry['timestamp']
+    summary['cmdr'] = monitor.cmdr
+    context = dict([(attr, getattr(monitor, attr)) for attr in EDLogs.CONTEXT])
+    return (summary, context, monitor.state)
+
+
+# Parse all journal files in logdir in parallel. Returns the per-file summaries and the final context and state of
+# each Cmdr, in the same form as the monitor's after reading the files in order.
+def backfill(logdir, processes=None):
+    logfiles = [join(logdir, x) for x in listdir(logdir) if x.startswith('Journal.') and x.endswith('.log')]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(parse_file, logfiles, chunksize=4)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Each journal starts with a Fileheader which resets the monitor's state, so a Cmdr's state is that at the
+    # end of their most recent file.
+    results.sort(key = lambda x: (x[0]['last'] or '', x[0]['file']))
+    cmdrs = {}
+    for (summary, context, state) in results:
+        if summary['cmdr']:
+            cmdrs[summary['cmdr']] = dict(context, state=state, file=summary['file'])
+    return ([x[0] for x in results], cmdrs)
+
+
+if __name__ == "__main__":
+
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description='Rebuild Cmdr state and statistics from E:D journal files.')
+    parser.add_argument('dir', nargs='?', default=config.get('journaldir') or config.default_journal_dir, help='folder containing journal files, by default the configured journal folder')
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes, by default one per core')
+    parser.add_argument('-o', metavar='FILE', help='write results to FILE in json format')
+    args = parser.parse_args()
+
+    if not args.dir or not isdir(args.dir):
+        sys.stderr.write('No journal folder\n')
+        sys.exit(1)
+
+    (summaries, cmdrs) = backfill(args.dir, args.jobs)
+    results = json.dumps({ 'files': summaries, 'cmdrs': cmdrs }, ensure_ascii=False, indent=2, sort_keys=True, separators=(',', ': ')).encode('utf-8')
+    if args.o:
+        with open(args.o, 'wt') as h:
+            h.write(results)
+    else:
+        print results
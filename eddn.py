@@ -1,16 +1,20 @@
 # Export to EDDN
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
+import cPickle
+import hashlib
 import json
 import numbers
-from os import SEEK_SET, SEEK_CUR, SEEK_END
-from os.path import exists, join
+from os import listdir, makedirs, rename, unlink, SEEK_SET, SEEK_CUR, SEEK_END
+from os.path import exists, isdir, join
 from platform import system
 import re
 import requests
 from sys import platform
+import threading
 import time
 import uuid
+import zlib
 
 if platform != 'win32':
     from fcntl import lockf, LOCK_EX, LOCK_NB
@@ -25,58 +29,445 @@ from companion import category_map
 timeout= 10	# requests timeout
 module_re = re.compile('^Hpt_|^Int_|_Armour_')
 
-replayfile = None	# For delayed messages
+replayfile = None	# For delayed messages. Holds ReplayLog's lock.
+targets = []		# Endpoints that are sending, for display in settings
+
+
+class ReplayLog:
+    # Append-only log of messages waiting to be sent, stored as numbered segment files in a folder. The position
+    # of the oldest unsent message is kept in a separate file, so acknowledging a message costs O(1) I/O.
+    # Only a window of the oldest unsent messages is held in memory. Not thread-safe.
+
+    SEGMENT = 1000	# Messages per segment file
+    WINDOW = 100	# Max unsent messages to hold in memory
+    COMMITTED = 'committed'	# Holds the segment number and offset of the oldest unsent message
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.committed = None	# Open committed file, which is locked to prevent another copy of the app using the log
+        self.writer = None	# Open tail segment
+        self.tail = 0		# Number of the tail segment
+        self.tailcount = 0	# Number of messages in the tail segment
+        self.head = (0, 0)	# (segment, offset) of the oldest unsent message
+        self.reader = (0, 0)	# (segment, offset) of the next message to read into window
+        self.readh = None	# (segment, open file) for reading
+        self.window = deque()	# [segment, end offset, line, state] of messages read, oldest first
+        self.pending = 0	# Number of unsent messages
+
+    # Window states
+    FREE, SENDING, SENT = range(3)
+
+    def segment(self, n):
+        return join(self.logdir, '%08d.jsonl' % n)
+
+    def open(self):
+        # Raises an exception if the log can't be opened, e.g. if another copy of the app is using it
+        if not isdir(self.logdir):
+            makedirs(self.logdir)
+        filename = join(self.logdir, self.COMMITTED)
+        self.committed = open(filename, exists(filename) and 'r+' or 'w+')
+        if platform != 'win32':	# open for writing is automatically exclusive on Windows
+            lockf(self.committed, LOCK_EX|LOCK_NB)
+        fields = self.committed.read().split()
+        segments = sorted([int(x.split('.')[0]) for x in listdir(self.logdir) if x.endswith('.jsonl') and x.split('.')[0].isdigit()])
+        if len(fields) == 2:
+            self.head = (int(fields[0]), int(fields[1]))
+        elif segments:
+            self.head = (segments[0], 0)
+        self.tail = max(segments + [self.head[0]])
+        self.reader = self.head
+
+        # Count unsent messages, without holding them in memory
+        self.pending = 0
+        for n in segments:
+            if n >= self.head[0]:
+                with open(self.segment(n), 'rb') as h:
+                    count = sent = offset = 0
+                    for line in h:
+                        count += 1
+                        offset += len(line)
+                        if n == self.head[0] and offset <= self.head[1]:
+                            sent += 1
+                self.pending += count - sent
+                if n == self.tail:
+                    self.tailcount = count	# Including sent messages, so that the segment doesn't grow past SEGMENT
+        self.writer = open(self.segment(self.tail), 'ab')
+
+    def close(self):
+        self.closereader()
+        if self.writer:
+            self.writer.close()
+        if self.committed:
+            self.committed.close()
+        self.writer = self.committed = None
+
+    def append(self, line):
+        if self.tailcount >= self.SEGMENT:
+            self.writer.close()
+            self.tail += 1
+            self.tailcount = 0
+            self.writer = open(self.segment(self.tail), 'ab')
+        self.writer.write('%s\n' % line)
+        self.writer.flush()
+        self.tailcount += 1
+        self.pending += 1
+
+    def take(self):
+        # Oldest message that isn't being sent, as a window item, or None
+        for item in self.window:
+            if item[3] == self.FREE:
+                item[3] = self.SENDING
+                return item
+        if len(self.window) < self.WINDOW and self.read():
+            item = self.window[-1]
+            item[3] = self.SENDING
+            return item
+        return None
+
+    def read(self):
+        # Read the next message from disk into window. Returns False if there are no more.
+        while True:
+            (n, offset) = self.reader
+            if not self.readh or self.readh[0] != n:
+                self.closereader()
+                try:
+                    self.readh = (n, open(self.segment(n), 'rb'))
+                except IOError:
+                    self.readh = None	# Segment file has gone missing
+            if self.readh:
+                self.readh[1].seek(offset, SEEK_SET)
+                line = self.readh[1].readline()
+                if line.endswith('\n'):
+                    self.reader = (n, offset + len(line))
+                    self.window.append([n, offset + len(line), line.strip(), self.FREE])
+                    return True
+            if n >= self.tail:
+                return False
+            self.reader = (n + 1, 0)	# Move on to next segment
+
+    def closereader(self):
+        if self.readh:
+            self.readh[1].close()
+        self.readh = None
+
+    def release(self, item):
+        # Message couldn't be sent - make it available to send again
+        item[3] = self.FREE
+
+    def ack(self, item):
+        # Message has been sent, or should be discarded
+        item[3] = self.SENT
+        self.pending -= 1
+        head = None
+        while self.window and self.window[0][3] == self.SENT:
+            head = self.window.popleft()
+        if head:
+            oldhead = self.head[0]
+            self.head = (head[0], head[1])
+            self.committed.seek(0, SEEK_SET)
+            self.committed.write('%08d %012d\n' % self.head)	# Fixed width so no need to truncate
+            self.committed.flush()
+            for n in range(oldhead, self.head[0]):
+                try:
+                    unlink(self.segment(n))	# Fully sent
+                except OSError:
+                    pass
+
+
+class Endpoint:
+    # An upload target, with its own queue of messages waiting to be sent, sender threads, pace and health, so
+    # that a slow or dead target doesn't hold up the others.
+
+    SENDERS = 4		# Default number of messages to send concurrently
+    PACE_MIN = 0.05	# Minimum interval between starting to send messages on each sender [s]
+    PACE_MAX = 60	# Default maximum interval between starting to send messages, when the target is in trouble [s]
+    RATE_WINDOW = 60	# Interval over which to measure throughput [s]
+    CLOSE_WAIT = 3	# Max time to wait on exit for messages being sent [s]. Unsent messages are kept in the replay log.
+
+    def __init__(self, eddn, url, logdir, senders=None, pace_max=None):
+        self.eddn = eddn
+        self.url = url
+        self.senders = senders or self.SENDERS
+        self.pace_max = pace_max or self.PACE_MAX
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.senders)	# One connection per sender
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.replaylog = ReplayLog(logdir)
+        self.lock = threading.Lock()	# Protects replaylog and the sending state below
+        self.wakeup = threading.Event()	# Set when there are messages to send
+        self.progress = threading.Condition(self.lock)	# Notified when a message is appended, sent or released
+        self.closing = threading.Event()	# Set to interrupt pacing delays on shutdown
+        self.threads = []
+        self.pace_min = self.PACE_MIN / self.senders	# Start times are spaced out across all senders
+        self.pace = self.pace_min	# Current interval between starting to send messages [s]
+        self.next_send = 0		# Time at which the next message can be sent
+        self.error = None		# Description of last error, if sending is stalled
+        self.recent = deque()		# Times at which messages were sent, for measuring throughput
+        self.counters = { 'messages': 0, 'bytes': 0, 'uploaded': 0, 'compressed': 0, 'retries': 0 }
+
+    def start(self):
+        if not self.threads:
+            self.closing.clear()
+            for i in range(self.senders):
+                thread = threading.Thread(target = self.worker, name = 'EDDN sender %d %s' % (i, self.url))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def close(self, deadline=None):
+        # Called on the main thread, so only waits until deadline for messages being sent
+        threads = self.threads
+        self.threads = []	# Orphan the sender threads
+        self.closing.set()
+        self.wakeup.set()
+        with self.lock:
+            self.progress.notify_all()
+        deadline = deadline or time.time() + self.CLOSE_WAIT
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        with self.lock:
+            self.replaylog.close()
+
+    def append(self, line):
+        with self.lock:
+            self.replaylog.append(line)
+            self.progress.notify()
+
+    def post(self, data, headers, size):
+        # Send an encoded message. Raises an exception on failure.
+        r = self.session.post(self.url, data=data, headers=headers, timeout=timeout)
+        if __debug__ and r.status_code != requests.codes.ok:
+            print 'Status\t%s'  % r.status_code
+            print 'URL\t%s'  % r.url
+            print 'Headers\t%s' % r.headers
+            print ('Content:\n%s' % r.text).encode('utf-8')
+        r.raise_for_status()
+        with self.lock:
+            self.counters['messages'] += 1
+            self.counters['bytes'] += size
+            self.counters['uploaded'] += len(data)
+            self.counters['compressed'] += bool(headers)
+        with self.eddn.lock:
+            self.eddn.counters['messages'] += 1
+            self.eddn.counters['bytes'] += size
+            self.eddn.counters['uploaded'] += len(data)
+            self.eddn.counters['compressed'] += bool(headers)
+
+    def worker(self):
+        # Runs in each sender thread. Takes the oldest message that isn't already being sent, and sends it.
+        while True:
+            self.wakeup.wait()
+            if threading.current_thread() not in self.threads:
+                return	# Terminate
+
+            with self.lock:
+                if not self.replaylog.committed:
+                    return	# Log has been closed
+                item = self.replaylog.take()
+                if item is None:
+                    if not self.replaylog.pending:
+                        self.wakeup.clear()	# All sent
+                    elif threading.current_thread() in self.threads:
+                        self.progress.wait()	# Other senders are busy with the remaining messages
+                    continue
+
+                # Pace requests by spacing out their start times
+                now = time.time()
+                delay = self.next_send - now
+                self.next_send = max(now, self.next_send) + self.pace
+
+            if delay > 0:
+                self.closing.wait(delay)
+            if threading.current_thread() not in self.threads:
+                return	# Terminate, leaving the message in the log for next time
+            sent = self.sendline(item[2])
+
+            with self.lock:
+                if not self.replaylog.committed:
+                    return	# Log was closed while sending - the message will be sent again next time
+                if sent:
+                    self.replaylog.ack(item)
+                else:
+                    self.replaylog.release(item)
+                    self.counters['retries'] += 1
+                self.progress.notify()
+            if not self.closing.is_set():
+                self.eddn.notify()	# Not on exit, since the main thread may be waiting for us
+
+    def sendline(self, line):
+        # Send one message from replaylog and adjust the pace. Returns False if it should be retried later.
+        try:
+            entry = json.loads(line, object_pairs_hook=OrderedDict)
+            (cmdr, msg) = entry[:2]
+            self.post(*self.eddn.encode(cmdr, msg))
+        except requests.exceptions.HTTPError as e:
+            if __debug__: print_exc()
+            status = e.response.status_code
+            if status == 429 or status >= 500:
+                self.backoff(e.response.headers.get('Retry-After'))
+                self.error = _("Error: Can't connect to EDDN")
+                return False
+            # Target rejected the message so it will never be accepted - discard and continue
+        except requests.exceptions.RequestException as e:
+            if __debug__: print_exc()
+            self.backoff()
+            self.error = _("Error: Can't connect to EDDN")
+            return False
+        except Exception as e:
+            # Couldn't decode - shouldn't happen!
+            if __debug__:
+                print line
+                print_exc()
+        else:
+            now = time.time()
+            with self.lock:
+                self.pace = max(self.pace_min, self.pace / 2)
+                self.error = None
+                self.recent.append(now)
+                while self.recent[0] < now - self.RATE_WINDOW:
+                    self.recent.popleft()
+        return True
+
+    def backoff(self, retryafter=None):
+        # Target is overloaded or unreachable, so slow down
+        try:
+            retryafter = float(retryafter)
+        except (TypeError, ValueError):
+            retryafter = 0
+        with self.lock:
+            self.pace = min(self.pace_max, max(self.pace * 2, retryafter))
+            self.next_send = max(self.next_send, time.time() + self.pace)
+
+    def stats(self):
+        # Health and throughput, for display
+        with self.lock:
+            now = time.time()
+            lag = 0	# Time that the oldest unsent message has been waiting [s]
+            for item in self.replaylog.window:
+                if item[3] != ReplayLog.SENT:
+                    try:
+                        lag = now - json.loads(item[2])[2]
+                    except:
+                        pass	# Older messages don't have the time they were queued
+                    break
+            stats = dict(self.counters)
+            stats.update({
+                'url'     : self.url,
+                'pending' : self.replaylog.pending,
+                'error'   : self.error,
+                'pace'    : self.pace,
+                'lag'     : lag,
+                'rate'    : len([x for x in self.recent if x >= now - self.RATE_WINDOW]) / float(self.RATE_WINDOW),	# [messages/s]
+            })
+        return stats
+
 
 class EDDN:
 
     ### UPLOAD = 'http://localhost:8081/upload/'	# testing
     UPLOAD = 'http://eddn-gateway.elite-markets.net:8080/upload/'
-    REPLAYPERIOD = 400	# Roughly two messages per second, accounting for send delays [ms]
-    REPLAYFLUSH = 20	# Update log on disk roughly every 10 seconds
+    GZIP_MIN = 512	# Compress messages larger than this [bytes]. Overridden by 'eddn_gzip_min', or 'eddn_nogzip' to never compress.
+    DUPLICATE_TTL = 3600	# Don't resend identical station data within this interval [s]. Overridden by 'eddn_duplicate_ttl'.
+    _SENT = 'eddn.p'	# Hashes of recently sent station data in datadir
 
-    def __init__(self, parent):
+    def __init__(self, parent, datadir=None, endpoints=None):
         self.parent = parent
-        self.session = requests.Session()
-        self.replaylog = []
+        self.datadir = datadir or config.app_dir	# For replay logs and other saved data
+
+        # Upload targets, from 'eddn_endpoints' by default. Each is 'URL [senders [max retry interval]]'. The first
+        # is the primary target - station data is sent to it immediately, and its progress is shown in the status bar.
+        self.endpoints = []
+        for spec in endpoints or config.get('eddn_endpoints') or [self.UPLOAD]:
+            fields = spec.split()
+            logdir = join(self.datadir, self.endpoints and 'replay-%s' % hashlib.sha1(fields[0]).hexdigest()[:8] or 'replay')
+            self.endpoints.append(Endpoint(self, fields[0], logdir, len(fields) > 1 and int(fields[1]) or None, len(fields) > 2 and float(fields[2]) or None))
+        self.primary = self.endpoints[0]
+
+        self.lock = threading.Lock()	# Protects counters
+        self.counters = { 'messages': 0, 'bytes': 0, 'uploaded': 0, 'compressed': 0, 'duplicates': 0 }	# bytes before and uploaded after compression, over all targets
+        self.sent = {}			# (system, station, schema) -> (hash of message, time sent) for station data
+        try:
+            with open(join(self.datadir, self._SENT), 'rb') as h:
+                self.sent = cPickle.load(h)
+        except:
+            pass	# Missing or corrupt - doesn't matter
 
     def load(self):
         # Try to obtain exclusive access to the journal cache
-        global replayfile
-        filename = join(config.app_dir, 'replay.jsonl')
+        global replayfile, targets
+        if replayfile:
+            return True
         try:
-            try:
-                # Try to open existing file
-                replayfile = open(filename, 'r+')
-            except:
-                if exists(filename):
-                    raise	# Couldn't open existing file
-                else:
-                    replayfile = open(filename, 'w+')	# Create file
-            if platform != 'win32':	# open for writing is automatically exclusive on Windows
-                lockf(replayfile, LOCK_EX|LOCK_NB)
+            for endpoint in self.endpoints:
+                endpoint.replaylog.open()
         except:
             if __debug__: print_exc()
-            if replayfile:
-                replayfile.close()
-            replayfile = None
+            for endpoint in self.endpoints:
+                endpoint.replaylog.close()
             return False
-        self.replaylog = [line.strip() for line in replayfile]
-        return True
+        replayfile = self.primary.replaylog.committed
 
-    def flush(self):
-        replayfile.seek(0, SEEK_SET)
-        replayfile.truncate()
-        for line in self.replaylog:
-            replayfile.write('%s\n' % line)
-        replayfile.flush()
+        # Migrate from single file log
+        filename = join(self.datadir, 'replay.jsonl')
+        if exists(filename):
+            try:
+                with open(filename, 'rb') as h:
+                    for line in h:
+                        if line.strip():
+                            for endpoint in self.endpoints:
+                                endpoint.append(line.strip())
+                unlink(filename)
+            except:
+                if __debug__: print_exc()
+
+        for endpoint in self.endpoints:
+            endpoint.start()
+        targets = self.endpoints
+        return True
 
     def close(self):
-        global replayfile
-        if replayfile:
-            replayfile.close()
+        global replayfile, targets
+        for endpoint in self.endpoints:
+            endpoint.closing.set()	# Stop all targets before waiting for any of them
+        deadline = time.time() + Endpoint.CLOSE_WAIT
+        for endpoint in self.endpoints:
+            endpoint.close(deadline)
         replayfile = None
+        targets = []
 
-    def send(self, cmdr, msg):
+        # Save hashes of recently sent station data
+        filename = join(self.datadir, self._SENT)
+        try:
+            expiry = time.time() - self.duplicate_ttl()
+            with open(filename + '.tmp', 'wb') as h:
+                cPickle.dump(dict([(k, v) for (k, v) in self.sent.iteritems() if v[1] > expiry]), h, cPickle.HIGHEST_PROTOCOL)
+            if exists(filename):
+                unlink(filename)	# Windows can't rename over an existing file
+            rename(filename + '.tmp', filename)
+        except:
+            if __debug__: print_exc()
+
+    def duplicate_ttl(self):
+        return config.getint('eddn_duplicate_ttl') or self.DUPLICATE_TTL
+
+    def gzip_min(self):
+        return not config.getint('eddn_nogzip') and (config.getint('eddn_gzip_min') or self.GZIP_MIN) or None
+
+    def send_station(self, cmdr, msg):
+        # Send station data, unless identical data was sent for the same station recently
+        key = (msg['message']['systemName'], msg['message']['stationName'], msg['$schemaRef'])
+        digest = hashlib.sha1(json.dumps(msg['message'], sort_keys=True)).hexdigest()
+        last = self.sent.get(key)
+        if last and last[0] == digest and time.time() - last[1] < self.duplicate_ttl():
+            with self.lock:
+                self.counters['duplicates'] += 1
+            return
+        self.send(cmdr, msg)
+        self.sent[key] = (digest, time.time())
+
+    def encode(self, cmdr, msg):
+        # Returns (body, headers, uncompressed size) for uploading
         if config.getint('anonymous'):
             uploaderID = config.get('uploaderID')
             if not uploaderID:
@@ -93,51 +484,52 @@ class EDDN:
         if not msg['message'].get('timestamp'):	# already present in journal messages
             msg['message']['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(config.getint('querytime') or int(time.time())))
 
-        r = self.session.post(self.UPLOAD, data=json.dumps(msg), timeout=timeout)
-        if __debug__ and r.status_code != requests.codes.ok:
-            print 'Status\t%s'  % r.status_code
-            print 'URL\t%s'  % r.url
-            print 'Headers\t%s' % r.headers
-            print ('Content:\n%s' % r.text).encode('utf-8')
-        r.raise_for_status()
+        data = json.dumps(msg)
+        size = len(data)
+        headers = {}
+        gzip_min = self.gzip_min()
+        if gzip_min is not None and size > gzip_min:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)	# gzip format
+            data = compressor.compress(data) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        return (data, headers, size)
 
-    def sendreplay(self):
-        if not replayfile:
-            return	# Probably closing app
+    def send(self, cmdr, msg):
+        # Send immediately to the primary target, and queue for any others
+        if len(self.endpoints) > 1 and replayfile:
+            line = json.dumps([cmdr.encode('utf-8'), msg, time.time()])
+            for endpoint in self.endpoints[1:]:
+                endpoint.append(line)
+                endpoint.wakeup.set()
+        self.primary.post(*self.encode(cmdr, msg))
 
-        if not self.replaylog:
-            self.parent.status['text'] = ''
-            return
+    def sendreplay(self):
+        # Send queued messages in the background
+        for endpoint in self.endpoints:
+            endpoint.wakeup.set()
 
-        if len(self.replaylog) == 1:
-            self.parent.status['text'] = _('Sending data to EDDN...')
-        else:
-            self.parent.status['text'] = '%s [%d]' % (_('Sending data to EDDN...').replace('...',''), len(self.replaylog))
-        self.parent.w.update_idletasks()
+    def notify(self):
+        # Tell the main thread about progress. Called from a sender thread.
         try:
-            cmdr, msg = json.loads(self.replaylog[0], object_pairs_hook=OrderedDict)
+            self.parent.w.event_generate('<<EDDNStatus>>', when="tail")
         except:
-            # Couldn't decode - shouldn't happen!
-            if __debug__:
-                print self.replaylog[0]
-                print_exc()
-            self.replaylog.pop(0)	# Discard and continue
+            pass	# Main window has gone away
+
+    def status(self):
+        # Progress text to show in the main window
+        if self.primary.error:
+            return self.primary.error
+        count = self.primary.replaylog.pending
+        if not self.primary.wakeup.is_set() or not count:
+            return ''
+        elif count == 1:
+            return _('Sending data to EDDN...')
         else:
-            try:
-                self.send(cmdr, msg)
-                self.replaylog.pop(0)
-                if not len(self.replaylog) % self.REPLAYFLUSH:
-                    self.flush()
-            except requests.exceptions.RequestException as e:
-                if __debug__: print_exc()
-                self.parent.status['text'] = _("Error: Can't connect to EDDN")
-                return	# stop sending
-            except Exception as e:
-                if __debug__: print_exc()
-                self.parent.status['text'] = unicode(e)
-                return	# stop sending
+            return '%s [%d]' % (_('Sending data to EDDN...').replace('...',''), count)
 
-        self.parent.w.after(self.REPLAYPERIOD, self.sendreplay)
+    def stats(self):
+        # Health, throughput and lag of each target
+        return [endpoint.stats() for endpoint in self.endpoints]
 
     def export_commodities(self, data):
         commodities = []
@@ -158,7 +550,7 @@ class EDDN:
 
         # Don't send empty commodities list - schema won't allow it
         if commodities:
-            self.send(data['commander']['name'], {
+            self.send_station(data['commander']['name'], {
                 '$schemaRef' : 'http://schemas.elite-markets.net/eddn/commodity/3',
                 'message'    : {
                     'systemName'  : data['lastSystem']['name'],
@@ -170,7 +562,7 @@ class EDDN:
     def export_outfitting(self, data):
         # Don't send empty modules list - schema won't allow it
         if data['lastStarport'].get('modules'):
-            self.send(data['commander']['name'], {
+            self.send_station(data['commander']['name'], {
                 '$schemaRef' : 'http://schemas.elite-markets.net/eddn/outfitting/2',
                 'message'    : {
                     'systemName'  : data['lastSystem']['name'],
@@ -182,7 +574,7 @@ class EDDN:
     def export_shipyard(self, data):
         # Don't send empty ships list - shipyard data is only guaranteed present if user has visited the shipyard.
         if data['lastStarport'].get('ships'):
-            self.send(data['commander']['name'], {
+            self.send_station(data['commander']['name'], {
                 '$schemaRef' : 'http://schemas.elite-markets.net/eddn/shipyard/2',
                 'message'    : {
                     'systemName'  : data['lastSystem']['name'],
@@ -196,13 +588,21 @@ class EDDN:
             '$schemaRef' : 'http://schemas.elite-markets.net/eddn/journal/1' + (is_beta and '/test' or ''),
             'message'    : entry
         }
-        if replayfile or self.load():
-            # Store the entry
-            self.replaylog.append(json.dumps([cmdr.encode('utf-8'), msg]))
-            replayfile.write('%s\n' % self.replaylog[-1])
+        self.enqueue(cmdr, msg, entry['event'] == 'Docked' or not (config.getint('output') & config.OUT_SYS_DELAY))
+
+    def export_blackmarket(self, cmdr, is_beta, msg):
+        self.enqueue(cmdr, {
+            '$schemaRef' : 'http://schemas.elite-markets.net/eddn/blackmarket/1' + (is_beta and '/test' or ''),
+            'message'    : msg
+        })
 
-            if entry['event'] == 'Docked' or not (config.getint('output') & config.OUT_SYS_DELAY):
-                # Try to send this and previous entries
+    def enqueue(self, cmdr, msg, sendnow=True):
+        # Store the message in the replay log, and send it and any previous messages in the background if sendnow
+        if replayfile or self.load():
+            line = json.dumps([cmdr.encode('utf-8'), msg, time.time()])	# Serialized once for all targets
+            for endpoint in self.endpoints:
+                endpoint.append(line)
+            if sendnow:
                 self.sendreplay()
         else:
             # Can't access replay file! Send immediately.
@@ -210,9 +610,3 @@ class EDDN:
             self.parent.w.update_idletasks()
             self.send(cmdr, msg)
             self.parent.status['text'] = ''
-
-    def export_blackmarket(self, cmdr, is_beta, msg):
-        self.send(cmdr, {
-            '$schemaRef' : 'http://schemas.elite-markets.net/eddn/blackmarket/1' + (is_beta and '/test' or ''),
-            'message'    : msg
-        })
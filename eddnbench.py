@@ -0,0 +1,286 @@
+#!/usr/bin/python
+#
+# Local stand-in for the EDDN gateway, and a load test that pushes messages through EDDN's sender threads to it
+#
+
+import argparse
+import BaseHTTPServer
+from collections import Counter
+import json
+import random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+from time import sleep, time
+import zlib
+
+import eddn
+import journalbench
+from journalbench import percentile
+from l10n import Translations
+
+
+# Required properties of the message in each schema that we send, by schema name. A small subset of the real
+# schemas at https://github.com/jamesremuscat/EDDN/tree/master/schemas, enough to catch malformed messages.
+SCHEMAS = {
+    'journal/1'     : ['timestamp', 'event', 'StarSystem', 'StarPos'],
+    'commodity/3'   : ['systemName', 'stationName', 'timestamp', 'commodities'],
+    'outfitting/2'  : ['systemName', 'stationName', 'timestamp', 'modules'],
+    'shipyard/2'    : ['systemName', 'stationName', 'timestamp', 'ships'],
+    'blackmarket/1' : ['systemName', 'stationName', 'timestamp', 'name', 'sellPrice', 'prohibited'],
+}
+HEADER = ['uploaderID', 'softwareName', 'softwareVersion']
+DISALLOWED = ['CockpitBreach', 'BoostUsed', 'FuelLevel', 'FuelUsed', 'JumpDist']	# in journal messages
+
+
+# Validate a decoded upload. Returns the schema name, or raises ValueError.
+def validate(msg):
+    ref = msg.get('$schemaRef', '')
+    schema = ref.split('/eddn/', 1)[-1]
+    if schema.endswith('/test'):
+        schema = schema[:-5]
+    if schema not in SCHEMAS:
+        raise ValueError('Unknown schema "%s"' % ref)
+    for prop in HEADER:
+        if not msg.get('header', {}).get(prop):
+            raise ValueError('Missing header property "%s"' % prop)
+    for prop in SCHEMAS[schema]:
+        if prop not in msg.get('message', {}):
+            raise ValueError('Missing %s property "%s"' % (schema, prop))
+    if schema == 'journal/1':
+        for prop in msg['message']:
+            if prop in DISALLOWED or prop.endswith('_Localised'):
+                raise ValueError('Disallowed journal property "%s"' % prop)
+    return schema
+
+
+class Gateway(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Mimics the EDDN upload endpoint. Optionally delays responses and fails a fraction of requests with 503.
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, jitter=0, errors=0, record=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), GatewayHandler)
+        self.latency = latency	# [s]
+        self.jitter = jitter	# [s]
+        self.errors = errors	# Fraction of requests to fail
+        self.record = record	# Open file to write received messages to, or None
+        self.lock = threading.Lock()
+        self.received = Counter()	# Valid messages by schema name
+        self.invalid = 0
+        self.failed = 0		# Injected errors
+        self.bytes = 0		# Uploaded bytes, possibly compressed
+        self.seen = set()	# BenchSeq of journal messages, for spotting missing or duplicate messages
+        self.duplicates = 0
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, name = 'EDDN gateway')
+        thread.daemon = True
+        thread.start()
+
+    def url(self):
+        return 'http://127.0.0.1:%d/upload/' % self.server_address[1]
+
+
+class GatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        gateway = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        sleep(max(0, gateway.latency + random.uniform(-gateway.jitter, gateway.jitter)))
+        if random.random() < gateway.errors:
+            with gateway.lock:
+                gateway.failed += 1
+            return self.reply(503, 'Injected error')
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                data = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            else:
+                data = body
+            msg = json.loads(data)
+            schema = validate(msg)
+        except Exception as e:
+            with gateway.lock:
+                gateway.invalid += 1
+            return self.reply(400, unicode(e))
+        with gateway.lock:
+            gateway.received[schema] += 1
+            gateway.bytes += len(body)
+            seq = msg['message'].get('BenchSeq')
+            if seq is not None:
+                if seq in gateway.seen:
+                    gateway.duplicates += 1
+                gateway.seen.add(seq)
+            if gateway.record:
+                gateway.record.write(data + '\n')
+        self.reply(200, 'OK')
+
+    def reply(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(text.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass	# Too noisy
+
+
+# Stand-in for AppWindow as seen by EDDN
+class Parent:
+
+    class Window:
+        def __init__(self):
+            self.events = 0
+        def event_generate(self, sequence, when=None):
+            self.events += 1	# <<EDDNStatus>> from a sender thread
+        def update_idletasks(self):
+            pass
+
+    def __init__(self):
+        self.w = self.Window()
+        self.status = {}
+
+
+# Journal entries that we'd send to EDDN, prepared in the same way as AppWindow.journal_event
+def journal_messages(n, seed):
+    entries = []
+    system = coordinates = None
+    for line in journalbench.generate(n * 3, seed):
+        entry = json.loads(line)
+        if 'StarPos' in entry:
+            system, coordinates = entry['StarSystem'], entry['StarPos']
+        if entry['event'] in ['FSDJump', 'Docked', 'Scan'] and coordinates:
+            for thing in DISALLOWED:
+                entry.pop(thing, None)
+            entry.setdefault('StarSystem', system)
+            entry.setdefault('StarPos', coordinates)
+            entries.append(entry)
+    return entries[:n]
+
+
+# Companion API data for a station, enough for export_commodities
+def station_data(i, rnd):
+    return {
+        'commander'    : { 'name': 'Bench' },
+        'lastSystem'   : { 'name': 'Bench Sector AB-C d%d' % i },
+        'lastStarport' : {
+            'name'        : 'Bench Port',
+            'commodities' : [{
+                'name': 'Commodity%d' % j, 'categoryname': 'Metals', 'meanPrice': 1000, 'buyPrice': rnd.randint(0, 2000),
+                'stock': rnd.randint(0, 5000), 'stockBracket': 2, 'sellPrice': rnd.randint(0, 2000), 'demand': 0,
+                'demandBracket': 0, 'statusFlags': [],
+            } for j in range(120)],
+        },
+    }
+
+
+# Push messages through EDDN to the gateways and report throughput, backlog drain time and main thread blocking.
+# If dead, also configure an upload target that refuses connections, which mustn't hold up the others.
+def loadtest(gateways, journal, commodities, blackmarket, seed=0, senders=None, dead=False, timeout=300):
+    rnd = random.Random(seed)
+    datadir = tempfile.mkdtemp()
+    parent = Parent()
+    endpoints = ['%s %d' % (gateway.url(), senders or eddn.Endpoint.SENDERS) for gateway in gateways]
+    if dead:
+        endpoints.append('http://127.0.0.1:1/upload/')
+    sender = eddn.EDDN(parent, datadir, endpoints)
+    live = sender.endpoints[:len(gateways)]
+    if not sender.load():
+        sys.stderr.write('Can\'t open replay log\n')
+        return False
+
+    messages = journal_messages(journal, seed)
+    blocked = []	# Time that the main thread spent in each call [s]
+    start = time()
+
+    # Journal and blackmarket messages are queued in the replay log, as while flying around
+    for (i, entry) in enumerate(messages):
+        entry['BenchSeq'] = i
+        t = time()
+        sender.export_journal_entry('Bench', False, entry)
+        blocked.append(time() - t)
+    for i in range(blackmarket):
+        t = time()
+        sender.export_blackmarket('Bench', False, { 'systemName': 'Sol', 'stationName': 'Bench Port', 'timestamp': '2017-06-01T00:00:00Z', 'name': 'Commodity%d' % i, 'sellPrice': 100, 'prohibited': False })
+        blocked.append(time() - t)
+    t = time()
+    sender.sendreplay()
+    blocked.append(time() - t)
+    queued = time() - start
+
+    # Station data is sent synchronously, as when docked
+    station = []
+    stationsent = 0
+    for i in range(commodities):
+        t = time()
+        try:
+            sender.export_commodities(station_data(i, rnd))
+            stationsent += 1
+        except:
+            pass	# Injected error - the user would be told and could retry
+        station.append(time() - t)
+
+    # Wait for the live targets' replay logs to drain
+    while any([x.replaylog.pending for x in live]) and time() - start < timeout:
+        sleep(0.05)
+    drained = time() - start
+    pending = sum([x.replaylog.pending for x in live])
+    stats = sender.stats()
+    sender.close()
+    shutil.rmtree(datadir, ignore_errors=True)
+
+    total = len(messages) + blackmarket
+    print 'queued     %8d msgs %8.2fs  main thread per message p50 %.2fms p99 %.2fms max %.2fms' % (total, queued, percentile(blocked, 50) * 1000, percentile(blocked, 99) * 1000, max(blocked or [0]) * 1000)
+    print 'drained    %8d msgs %8.2fs %8.0f msgs/s  pending %d  status events %d' % (total * len(live) - pending, drained, (total * len(live) - pending) / (drained or 1e-9), pending, parent.w.events)
+    if commodities:
+        print 'commodity  %8d/%d msgs         per message p50 %.1fms max %.1fms' % (stationsent, commodities, percentile(station, 50) * 1000, max(station) * 1000)
+    for gateway in gateways:
+        print 'gateway    %s  invalid %d  injected errors %d  duplicates %d  missing %d  %dKB' % (', '.join(['%s %d' % x for x in sorted(gateway.received.items())]), gateway.invalid, gateway.failed, gateway.duplicates, len(messages) - len(gateway.seen), gateway.bytes // 1024)
+    for x in stats:
+        print 'endpoint   %s  pending %d  sent %d  retries %d  %.1f msgs/s  lag %.1fs  pace %.2fs%s' % (x['url'], x['pending'], x['messages'], x['retries'], x['rate'], x['lag'], x['pace'], x['error'] and '  ' + x['error'] or '')
+    print 'sender     %s' % ', '.join(['%s %d' % x for x in sorted(sender.counters.items())])
+
+    # Every message should have arrived at every live gateway, and been valid
+    return not pending and all([not gateway.invalid and len(gateway.seen) == len(messages) and gateway.received['blackmarket/1'] >= blackmarket and gateway.received['commodity/3'] >= stationsent for gateway in gateways])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the EDDN gateway, and optionally load test EDDN uploads against it.')
+    parser.add_argument('-n', '--journal', type=int, default=2000, help='number of journal messages to send')
+    parser.add_argument('-c', '--commodities', type=int, default=20, help='number of commodity messages to send')
+    parser.add_argument('-b', '--blackmarket', type=int, default=100, help='number of blackmarket messages to send')
+    parser.add_argument('-s', '--senders', type=int, help='number of sender threads per upload target')
+    parser.add_argument('-g', '--gateways', type=int, default=1, help='number of gateways to upload to')
+    parser.add_argument('--dead', action='store_true', help='also upload to a target that refuses connections')
+    parser.add_argument('--latency', type=float, default=20, help='gateway response time [ms]')
+    parser.add_argument('--jitter', type=float, default=10, help='random variation in gateway response time [ms]')
+    parser.add_argument('--errors', type=float, default=0.02, help='fraction of requests to fail with 503')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--serve', metavar='PORT', type=int, help='just run the gateway on PORT until interrupted')
+    parser.add_argument('-o', metavar='FILE', help='write messages received by the gateway to FILE')
+    args = parser.parse_args()
+
+    Translations().install_dummy()
+    random.seed(args.seed)
+    record = args.o and open(args.o, 'wt') or None
+    if args.serve:
+        gateway = Gateway(args.serve, args.latency / 1000.0, args.jitter / 1000.0, args.errors, record)
+        print 'Listening on %s' % gateway.url()
+        try:
+            gateway.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        ok = True
+    else:
+        gateways = [Gateway(0, args.latency / 1000.0, args.jitter / 1000.0, args.errors, record) for i in range(args.gateways)]
+        for gateway in gateways:
+            gateway.start()
+        ok = loadtest(gateways, args.journal, args.commodities, args.blackmarket, args.seed, args.senders, args.dead)
+        for gateway in gateways:
+            gateway.shutdown()
+    if record:
+        record.close()
+    sys.exit(not ok)
@@ -1,4 +1,10 @@
+from collections import deque, OrderedDict
+import cPickle
+import hashlib
 import json
+from os import rename, unlink
+from os.path import exists, join
+import sqlite3
 import threading
 from sys import platform
 import time
@@ -12,6 +18,8 @@ from monitor import monitor
 if __debug__:
     from traceback import print_exc
 
+counters = { 'sent': 0, 'suppressed': 0 }	# Debounced updates, for display in settings
+
 
 if platform=='darwin':
     # mimimal implementation of requests interface since OpenSSL 0.9.8 on OSX
@@ -60,35 +68,200 @@ else:
     from requests import Session
 
 
+class ServerError(Exception):
+    def __unicode__(self):
+        return _("Error: Can't connect to EDSM")
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class Outbox:
+    # Updates waiting to be sent to EDSM, in a SQLite database so that they survive restarts. Not thread-safe.
+
+    _FILENAME = 'edsm.db'	# in config.app_dir
+
+    SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id		INTEGER PRIMARY KEY AUTOINCREMENT,
+    cmdr	TEXT NOT NULL,
+    endpoint	TEXT NOT NULL,
+    args	TEXT NOT NULL,
+    system	TEXT,
+    key		TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_key ON outbox (cmdr, key);
+'''
+
+    def __init__(self, filename=None):
+        self.db = sqlite3.connect(filename or join(config.app_dir, self._FILENAME), check_same_thread=False)	# Callers serialize access
+        self.db.executescript(self.SCHEMA)
+
+    # Save a request. If key is given, earlier unsent requests with the same Cmdr and key are superseded and
+    # removed. Returns (id of new request, [ids of superseded requests]).
+    def add(self, cmdr, endpoint, args, system=None, key=None):
+        with self.db:
+            superseded = key and [x for (x,) in self.db.execute('SELECT id FROM outbox WHERE cmdr=? AND key=?', (cmdr, key))] or []
+            if superseded:
+                self.db.execute('DELETE FROM outbox WHERE cmdr=? AND key=?', (cmdr, key))
+            rowid = self.db.execute('INSERT INTO outbox (cmdr, endpoint, args, system, key) VALUES (?,?,?,?,?)', (cmdr, endpoint, args, system, key)).lastrowid
+        return (rowid, superseded)
+
+    def remove(self, ids):
+        with self.db:	# One transaction
+            self.db.executemany('DELETE FROM outbox WHERE id=?', [(x,) for x in ids])
+
+    # Generator for saved requests as (id, cmdr, endpoint, args, system, key), oldest first
+    def load(self):
+        return self.db.execute('SELECT id, cmdr, endpoint, args, system, key FROM outbox ORDER BY id')
+
+    def close(self):
+        self.db.close()
+
+
+class SystemCache:
+    # Whether systems have known coordinates in EDSM, saved between sessions so that revisiting a system doesn't
+    # need a lookup. Systems in the bundled systems.p are assumed to have known coordinates.
+
+    _FILENAME = 'edsm.p'	# in config.app_dir
+    KNOWN_TTL = 30 * 24 * 60 * 60	# Look up again after this interval [s]
+    UNKNOWN_TTL = 24 * 60 * 60	# Look up systems without known coordinates again after this interval [s]
+
+    # Statuses
+    KNOWN, UNKNOWN = range(2)
+
+    def __init__(self, known=None, filename=None):
+        self.known = known or {}	# Container of names of systems with known coordinates, e.g. EDDB.system_ids
+        self.filename = filename or join(config.app_dir, self._FILENAME)
+        self.lock = threading.Lock()	# Protects systems
+        self.systems = {}	# system name -> (status, time looked up)
+        try:
+            with open(self.filename, 'rb') as h:
+                self.systems = cPickle.load(h)
+        except:
+            pass	# Missing or corrupt - doesn't matter
+
+    def get(self, system_name):
+        # Returns status, or None if never looked up or out of date
+        if system_name in self.known:
+            return self.KNOWN
+        entry = self.systems.get(system_name)
+        if entry and time.time() - entry[1] < (entry[0] == self.KNOWN and self.KNOWN_TTL or self.UNKNOWN_TTL):
+            return entry[0]
+        return None
+
+    def set(self, system_name, status):
+        if system_name in self.known:
+            return	# No need to save
+        with self.lock:
+            self.systems[system_name] = (status, time.time())
+
+    def __contains__(self, system_name):
+        return self.get(system_name) == self.KNOWN
+
+    def add(self, system_name):
+        self.set(system_name, self.KNOWN)
+
+    def save(self):
+        # Save, discarding out of date entries
+        now = time.time()
+        try:
+            with self.lock:
+                systems = dict([(k, v) for (k, v) in self.systems.iteritems() if now - v[1] < (v[0] == self.KNOWN and self.KNOWN_TTL or self.UNKNOWN_TTL)])
+            with open(self.filename + '.tmp', 'wb') as h:
+                cPickle.dump(systems, h, cPickle.HIGHEST_PROTOCOL)
+            if exists(self.filename):
+                unlink(self.filename)	# Windows can't rename over an existing file
+            rename(self.filename + '.tmp', self.filename)
+        except:
+            if __debug__: print_exc()
+
+
 class EDSM:
 
     _TIMEOUT = 10
+    _CLOSE_WAIT = 3	# Max time to wait on exit for requests in progress [s]. Unsent requests are kept in the outbox.
+    WORKERS = 4		# Max number of Cmdrs whose requests are sent concurrently
+    PREFETCH_WORKERS = 2	# Max number of systems to look up concurrently in advance
+    BATCH = 20		# Max number of a Cmdr's requests to send in one go
+    BACKOFF_MIN = 10	# Initial interval before retrying when EDSM can't be reached [s]
+    BACKOFF_MAX = 600	# Max interval before retrying [s]
+    DEBOUNCE = 5	# Interval over which to combine materials and ship updates [s]
     FAKE = ['CQC', 'Training', 'Destination']	# Fake systems that shouldn't be sent to EDSM
 
-    def __init__(self):
+    def __init__(self, parent, known=None):
+        self.parent = parent
         self.result = { 'img': None, 'url': None, 'done': True }
-        self.syscache = set()	# Cache URLs of systems with known coordinates
+        self.syscache = SystemCache(known)
         self.session = Session()
         self.lastship = None	# Description of last ship that we sent to EDSM
 
+        # Requests are sent in the background, in order for each Cmdr
+        self.lock = threading.Lock()	# Protects the request queues, outbox and state below
+        self.wakeup = threading.Condition(self.lock)	# Notified when there are requests to send
+        self.queues = OrderedDict()	# Cmdr -> deque of pending requests (outbox id or None, function, args), in round-robin order
+        self.busy = set()		# Cmdrs with requests being sent
+        self.threads = []
+        self.backoff = {}		# Cmdr -> current interval before retrying, while EDSM can't be reached [s]
+        self.next_try = {}		# Cmdr -> time at which to retry
+        self.error = None		# Description of last error, until collected by get_error
+
+        # Upcoming systems are looked up in the background by a separate pool so as not to delay other requests
+        self.prefetching = deque()	# (cmdr, system name) waiting to be looked up
+        self.prefetch_wakeup = threading.Condition(self.lock)	# Notified when there are systems to look up
+        self.prefetch_threads = []
+
+        # Materials and ship updates are combined over a short interval, and only changed values are sent
+        self.debounced = OrderedDict()	# (cmdr, key) -> (endpoint, fixed args, OrderedDict of values that are sent if changed, outbox key)
+        self.debounce_timer = None
+        self.digests = {}		# (cmdr, key, name or None for fixed args) -> hash of value last sent
+        self.counters = counters
+
+        # Resume sending requests saved last time
+        try:
+            self.outbox = Outbox()
+            for (rowid, cmdr, endpoint, args, system_name, key) in self.outbox.load():
+                self.queues.setdefault(cmdr, deque()).append((rowid, system_name and self._writelog or self._call, (endpoint, args, system_name, None)))
+        except:
+            if __debug__: print_exc()
+            self.outbox = None	# Send without saving
+        if self.queues:
+            with self.lock:
+                self.start()
+
         # Can't be in class definition since can only call PhotoImage after window is created
         EDSM._IMG_KNOWN    = tk.PhotoImage(data = 'R0lGODlhEAAQAMIEAFWjVVWkVWS/ZGfFZ////////////////yH5BAEKAAQALAAAAAAQABAAAAMvSLrc/lAFIUIkYOgNXt5g14Dk0AQlaC1CuglM6w7wgs7rMpvNV4q932VSuRiPjQQAOw==')	# green circle
         EDSM._IMG_UNKNOWN  = tk.PhotoImage(data = 'R0lGODlhEAAQAKEDAGVLJ+ddWO5fW////yH5BAEKAAMALAAAAAAQABAAAAItnI+pywYRQBtA2CtVvTwjDgrJFlreEJRXgKSqwB5keQ6vOKq1E+7IE5kIh4kCADs=')	# red circle
         EDSM._IMG_NEW      = tk.PhotoImage(data = 'R0lGODlhEAAQAMZwANKVHtWcIteiHuiqLPCuHOS1MN22ZeW7ROG6Zuu9MOy+K/i8Kf/DAuvCVf/FAP3BNf/JCf/KAPHHSv7ESObHdv/MBv/GRv/LGP/QBPXOPvjPQfjQSvbRSP/UGPLSae7Sfv/YNvLXgPbZhP7dU//iI//mAP/jH//kFv7fU//fV//ebv/iTf/iUv/kTf/iZ/vgiP/hc/vgjv/jbfriiPriiv7ka//if//jd//sJP/oT//tHv/mZv/sLf/rRP/oYv/rUv/paP/mhv/sS//oc//lkf/mif/sUf/uPv/qcv/uTv/uUv/vUP/qhP/xP//pm//ua//sf//ubf/wXv/thv/tif/slv/tjf/smf/yYP/ulf/2R//2Sv/xkP/2av/0gP/ylf/2df/0i//0j//0lP/5cP/7a//1p//5gf/7ev/3o//2sf/5mP/6kv/2vP/3y//+jP///////////////////////////////////////////////////////////////yH5BAEKAH8ALAAAAAAQABAAAAePgH+Cg4SFhoJKPIeHYT+LhVppUTiPg2hrUkKPXWdlb2xHJk9jXoNJQDk9TVtkYCUkOy4wNjdGfy1UXGJYOksnPiwgFwwYg0NubWpmX1ArHREOFYUyWVNIVkxXQSoQhyMoNVUpRU5EixkcMzQaGy8xhwsKHiEfBQkSIg+GBAcUCIIBBDSYYGiAAUMALFR6FAgAOw==')
         EDSM._IMG_ERROR    = tk.PhotoImage(data = 'R0lGODlhEAAQAKEBAAAAAP///////////yH5BAEKAAIALAAAAAAQABAAAAIwlBWpeR0AIwwNPRmZuVNJinyWuClhBlZjpm5fqnIAHJPtOd3Hou9mL6NVgj2LplEAADs=')	  # BBC Mode 5 '?'
 
-    # Call an EDSM endpoint with args (which should be quoted)
-    def call(self, endpoint, args, check_msgnum=True):
+    # Call an EDSM endpoint with args (which should be quoted), using the credentials of cmdr or the current Cmdr.
+    # Raises ServerError if EDSM can't be reached, so that the request can be retried, or Exception if it failed
+    # for some other reason.
+    def call(self, endpoint, args, check_msgnum=True, cmdr=None):
+        try:
+            idx = config.get('cmdrs').index(cmdr or monitor.cmdr)
+            username = config.get('edsm_usernames')[idx]
+            apikey = config.get('edsm_apikeys')[idx]
+        except:
+            username = apikey = None
+        if not username or not apikey:
+            raise Exception(_('Error: Invalid Credentials'))
+        url = 'https://www.edsm.net/%s?commanderName=%s&apiKey=%s&fromSoftware=%s&fromSoftwareVersion=%s' % (
+            endpoint,
+            urllib2.quote(username.encode('utf-8')),
+            urllib2.quote(apikey),
+            urllib2.quote(applongname),
+            urllib2.quote(appversion),
+        ) + args
+
         try:
-            idx = config.get('cmdrs').index(monitor.cmdr)
-            url = 'https://www.edsm.net/%s?commanderName=%s&apiKey=%s&fromSoftware=%s&fromSoftwareVersion=%s' % (
-                endpoint,
-                urllib2.quote(config.get('edsm_usernames')[idx].encode('utf-8')),
-                urllib2.quote(config.get('edsm_apikeys')[idx]),
-                urllib2.quote(applongname),
-                urllib2.quote(appversion),
-            ) + args
             r = self.session.get(url, timeout=EDSM._TIMEOUT)
+        except:
+            if __debug__: print_exc()
+            raise ServerError()	# Connection failed or timed out
+        if r.status_code >= 500:
+            raise ServerError()
+        try:
             r.raise_for_status()
             reply = r.json()
             if not check_msgnum:
@@ -96,7 +269,7 @@ class EDSM:
             (msgnum, msg) = reply['msgnum'], reply['msg']
         except:
             if __debug__: print_exc()
-            raise Exception(_("Error: Can't connect to EDSM"))
+            raise Exception(_('Error: EDSM {MSG}').format(MSG=r.status_code >= 400 and 'HTTP %d' % r.status_code or 'invalid reply'))
 
         # Message numbers: 1xx = OK, 2xx = fatal error, 3xx = error (but not generated in practice), 4xx = ignorable errors
         if msgnum // 100 not in (1,4):
@@ -104,6 +277,185 @@ class EDSM:
         else:
             return reply
 
+    # Queue a request to be sent in the background, after any earlier requests for the same Cmdr. func is called
+    # as func(cmdr, endpoint, args[, system_name[, result]]). Unless durable is False the request is saved in the
+    # outbox until sent, and if key is given it supersedes any unsent request with the same key for the same Cmdr.
+    def enqueue(self, func, endpoint, args, system_name=None, result=None, key=None, durable=True, cmdr=None):
+        cmdr = cmdr or monitor.cmdr
+        self.flush(cmdr)	# Keep the Cmdr's requests in order
+        with self.lock:
+            queue = self.queues.setdefault(cmdr, deque())
+            rowid = None
+            if durable and self.outbox:
+                try:
+                    (rowid, superseded) = self.outbox.add(cmdr, endpoint, args, system_name, key)
+                    if superseded:
+                        for request in [x for x in queue if x[0] in superseded]:
+                            queue.remove(request)
+                except:
+                    if __debug__: print_exc()
+            queue.append((rowid, func, (endpoint, args, system_name, result)))
+            self.start()
+            self.wakeup.notify()
+
+    def start(self):
+        # Called with lock held
+        if not self.threads:
+            for i in range(self.WORKERS):
+                thread = threading.Thread(target = self.worker, name = 'EDSM worker %d' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def close(self):
+        # Give requests in progress a chance to finish. Requests still queued are sent next time.
+        if self.debounce_timer:
+            self.parent.w.after_cancel(self.debounce_timer)
+            self.flush()
+        print 'EDSM: %d updates sent, %d combined or unchanged updates not sent' % (self.counters['sent'], self.counters['suppressed'])
+        with self.lock:
+            threads = self.threads + self.prefetch_threads
+            self.threads = self.prefetch_threads = []	# Orphan the worker threads
+            self.wakeup.notify_all()
+            self.prefetch_wakeup.notify_all()
+        deadline = time.time() + self._CLOSE_WAIT
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))	# Called on the main thread, so mustn't hang
+        with self.lock:
+            if self.outbox:
+                self.outbox.close()
+                self.outbox = None
+        self.session.close()
+        self.syscache.save()
+
+    def worker(self):
+        # Runs in each worker thread. Sends a batch of the oldest requests of a Cmdr that doesn't have requests
+        # in progress. If EDSM can't be reached the rest of the batch is put back and sending for that Cmdr is paused.
+        # Requests that fail for other reasons, e.g. because EDSM rejected them, are reported and dropped.
+        while True:
+            with self.lock:
+                while True:
+                    if threading.current_thread() not in self.threads:
+                        return	# Terminate
+                    (batch, delay) = self.take()
+                    if batch:
+                        break
+                    self.wakeup.wait(delay)
+
+            (cmdr, requests) = batch
+            done = []	# ids of durable requests that have been sent or rejected
+            while requests:
+                if threading.current_thread() not in self.threads:
+                    break	# Terminating - put back the rest
+                (rowid, func, args) = requests[0]
+                try:
+                    func(cmdr, *args)
+                    with self.lock:
+                        self.backoff.pop(cmdr, None)
+                except ServerError as e:
+                    if __debug__: print_exc()
+                    if rowid is not None:
+                        with self.lock:
+                            if not self.backoff.get(cmdr):
+                                self.error = unicode(e)	# Only report when we first lose contact
+                            self.backoff[cmdr] = min(self.BACKOFF_MAX, max(self.BACKOFF_MIN, self.backoff.get(cmdr, 0) * 2))
+                            self.next_try[cmdr] = time.time() + self.backoff[cmdr]
+                        break	# Try again later
+                except Exception as e:
+                    if __debug__: print_exc()
+                    with self.lock:
+                        self.error = unicode(e)	# EDSM rejected the request, so don't retry
+                requests.pop(0)
+                if rowid is not None:
+                    done.append(rowid)
+
+            with self.lock:
+                if requests:
+                    self.queues.setdefault(cmdr, deque()).extendleft(reversed(requests))
+                if done and self.outbox:
+                    try:
+                        self.outbox.remove(done)
+                    except:
+                        if __debug__: print_exc()
+                self.busy.discard(cmdr)
+                if self.queues.get(cmdr):
+                    self.wakeup.notify()	# Cmdr's next requests can now be sent
+            if threading.current_thread() in self.threads:
+                self.notify()	# Not on exit, since the main thread may be waiting for us
+
+    def take(self):
+        # Called with lock held. Returns ((cmdr, [(id, function, args)]), None) or (None, time to wait until a
+        # Cmdr that is backing off can be retried [s], or None if there's nothing to retry).
+        now = time.time()
+        delay = None
+        for (cmdr, queue) in self.queues.items():
+            if cmdr not in self.busy and queue:
+                if self.next_try.get(cmdr, 0) > now:
+                    delay = min(delay or self.BACKOFF_MAX, self.next_try[cmdr] - now)
+                    continue
+                requests = [queue.popleft() for i in range(min(self.BATCH, len(queue)))]
+                del self.queues[cmdr]
+                if queue:
+                    self.queues[cmdr] = queue	# Move to the back for fairness between Cmdrs
+                self.busy.add(cmdr)
+                return ((cmdr, requests), None)
+        return (None, delay)
+
+    # Look up systems that we expect to visit soon, e.g. along a plotted route, so that their status is shown
+    # immediately on arrival
+    def prefetch(self, system_names):
+        cmdr = monitor.cmdr
+        with self.lock:
+            waiting = set([x[1] for x in self.prefetching])
+            for system_name in system_names:
+                if system_name and system_name not in self.FAKE and system_name not in waiting and self.syscache.get(system_name) is None:
+                    self.prefetching.append((cmdr, system_name))
+                    waiting.add(system_name)
+            if self.prefetching and not self.prefetch_threads:
+                for i in range(self.PREFETCH_WORKERS):
+                    thread = threading.Thread(target = self.prefetcher, name = 'EDSM prefetch %d' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self.prefetch_threads.append(thread)
+            self.prefetch_wakeup.notify_all()
+
+    def prefetcher(self):
+        # Runs in each prefetch thread. Failures are ignored - the system will be looked up again on arrival.
+        while True:
+            with self.lock:
+                while True:
+                    if threading.current_thread() not in self.prefetch_threads:
+                        return	# Terminate
+                    delay = self.prefetching and self.next_try.get(self.prefetching[0][0], 0) - time.time() or 0
+                    if self.prefetching and delay <= 0:
+                        (cmdr, system_name) = self.prefetching.popleft()
+                        break
+                    self.prefetch_wakeup.wait(delay > 0 and delay or None)
+
+            if self.syscache.get(system_name) is not None:
+                continue	# Looked up since it was queued
+            try:
+                data = self.call('api-v1/system', '&sysname=%s&coords=1' % urllib2.quote(system_name), False, cmdr)
+                if data and data != -1 and data.get('coords'):
+                    self.syscache.add(system_name)
+                else:
+                    self.syscache.set(system_name, SystemCache.UNKNOWN)
+            except:
+                if __debug__: print_exc()
+
+    def notify(self):
+        # Tell the main thread about progress. Called from a worker thread.
+        try:
+            self.parent.w.event_generate('<<EDSMStatus>>', when="tail")
+        except:
+            pass	# Main window has gone away
+
+    def get_error(self):
+        # Returns and clears the description of the last error, if any
+        with self.lock:
+            (error, self.error) = (self.error, None)
+        return error
+
     # Just set link without doing a lookup
     def link(self, system_name):
         self.cancel_lookup()
@@ -112,6 +464,7 @@ class EDSM:
         else:
             self.result = { 'img': '', 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': False }
 
+    # Look up whether the system's coordinates are known. The result is filled in in the background.
     def lookup(self, system_name, known=0):
         self.cancel_lookup()
 
@@ -119,45 +472,24 @@ class EDSM:
             self.result = { 'img': '', 'url': None, 'done': True, 'uncharted': False }
         elif known or system_name in self.syscache:
             self.result = { 'img': EDSM._IMG_KNOWN, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': False }
-        else:
-            self.result = { 'img': EDSM._IMG_ERROR, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': False }
-            data = self.call('api-v1/system', '&sysname=%s&coords=1' % urllib2.quote(system_name), check_msgnum=False)
-
-            if data == -1 or not data:
-                # System not present - but don't create it on the assumption that the caller will
-                self.result['img'] = EDSM._IMG_NEW
-                self.result['uncharted'] = True
-            elif data.get('coords'):
-                self.result['img'] = EDSM._IMG_KNOWN
-                self.syscache.add(system_name)
-            else:
-                self.result['img'] = EDSM._IMG_UNKNOWN
-                self.result['uncharted'] = True
-
-    # Asynchronous version of the above
-    def start_lookup(self, system_name, known=0):
-        self.cancel_lookup()
-
-        if system_name in self.FAKE:
-            self.result = { 'img': '', 'url': None, 'done': True, 'uncharted': False }
-        elif known or system_name in self.syscache:
-            self.result = { 'img': EDSM._IMG_KNOWN, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': False }
+        elif self.syscache.get(system_name) == SystemCache.UNKNOWN:
+            self.result = { 'img': EDSM._IMG_UNKNOWN, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': True }
         else:
             self.result = { 'img': '', 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': False, 'uncharted': False }
-            self.thread = threading.Thread(target = self.worker, name = 'EDSM worker', args = (system_name, self.result))
-            self.thread.daemon = True
-            self.thread.start()
+            self.enqueue(self._lookup, 'api-v1/system', '&sysname=%s&coords=1' % urllib2.quote(system_name), system_name, self.result, durable=False)
+
+    # Deprecated - lookup is now asynchronous
+    start_lookup = lookup
 
     def cancel_lookup(self):
-        self.thread = None	# orphan any existing thread
-        self.result = { 'img': '', 'url': None, 'done': True }	# orphan existing thread's results
+        self.result = { 'img': '', 'url': None, 'done': True }	# orphan existing request's results
 
-    def worker(self, system_name, result):
+    def _lookup(self, cmdr, endpoint, args, system_name, result):
         try:
-            data = self.call('api-v1/system', '&sysname=%s&coords=1' % urllib2.quote(system_name), check_msgnum=False)
+            data = self.call(endpoint, args, False, cmdr)
 
             if data == -1 or not data:
-                # System not present - create it
+                # System not present - but don't create it on the assumption that the caller will
                 result['img'] = EDSM._IMG_NEW
                 result['uncharted'] = True
             elif data.get('coords'):
@@ -166,10 +498,12 @@ class EDSM:
             else:
                 result['img'] = EDSM._IMG_UNKNOWN
                 result['uncharted'] = True
+                self.syscache.set(system_name, SystemCache.UNKNOWN)
         except:
-            if __debug__: print_exc()
             result['img'] = EDSM._IMG_ERROR
-        result['done'] = True
+            raise
+        finally:
+            result['done'] = True
 
 
     # Send flight log and also do lookup
@@ -179,7 +513,11 @@ class EDSM:
             self.result = { 'img': '', 'url': None, 'done': True, 'uncharted': False }
             return
 
-        self.result = { 'img': EDSM._IMG_ERROR, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': False }
+        if system_name in self.syscache:
+            # Show known status straight away. Will be updated when EDSM replies.
+            self.result = { 'img': EDSM._IMG_KNOWN, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': True, 'uncharted': False }
+        else:
+            self.result = { 'img': '', 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib2.quote(system_name), 'done': False, 'uncharted': False }
 
         args = '&systemName=%s&dateVisited=%s' % (
             urllib2.quote(system_name),
@@ -189,13 +527,32 @@ class EDSM:
             args += '&x=%.3f&y=%.3f&z=%.3f' % coordinates
         if shipid:
             args += '&shipId=%d' % shipid
-        reply = self.call('api-logs-v1/set-log', args)
+        self.enqueue(self._writelog, 'api-logs-v1/set-log', args, system_name, self.result)
 
-        if reply.get('systemCreated'):
-            self.result['img'] = EDSM._IMG_NEW
-        else:
-            self.result['img'] = EDSM._IMG_KNOWN
-        self.syscache.add(system_name)
+    def _writelog(self, cmdr, endpoint, args, system_name, result):
+        result = result or {}	# Not displayed if resumed from the outbox
+        try:
+            reply = self.call(endpoint, args, True, cmdr)
+            if reply.get('systemCreated'):
+                result['img'] = EDSM._IMG_NEW
+            else:
+                result['img'] = EDSM._IMG_KNOWN
+            self.syscache.add(system_name)
+        except:
+            result['img'] = EDSM._IMG_ERROR
+            raise
+        finally:
+            result['done'] = True
+
+    def _call(self, cmdr, endpoint, args, system_name=None, result=None):
+        self.call(endpoint, args, True, cmdr)
+
+    def _update(self, cmdr, endpoint, args, system_name, digests):
+        self.call(endpoint, args, True, cmdr)
+        with self.lock:
+            self.counters['sent'] += 1
+            if digests:	# Not available if resumed from the outbox
+                self.digests.update(digests)
 
     def setranks(self, ranks):
         args = ''
@@ -204,30 +561,59 @@ class EDSM:
                 if v is not None:
                     args += '&%s=%s' % (k, urllib2.quote('%d;%d' % v))
         if args:
-            self.call('api-commander-v1/set-ranks', args)
+            self.enqueue(self._call, 'api-commander-v1/set-ranks', args, key='ranks')
 
     def setcredits(self, balance, loan):
         if balance is not None:
-            self.call('api-commander-v1/set-credits', '&balance=%d&loan=%d' % (balance, loan))
+            self.enqueue(self._call, 'api-commander-v1/set-credits', '&balance=%d&loan=%d' % (balance, loan), key='credits')
+
+    # Queue an update to be sent at the end of the debounce interval. Values are merged with those of any update
+    # with the same key that is still waiting, and on sending values that haven't changed since last sent are omitted.
+    def debounce(self, key, endpoint, fixed, values, outboxkey=None):
+        pending = self.debounced.get((monitor.cmdr, key))
+        if pending:
+            pending[2].update(values)
+            self.counters['suppressed'] += 1
+        else:
+            self.debounced[(monitor.cmdr, key)] = (endpoint, fixed, OrderedDict(values), outboxkey)
+        if not self.debounce_timer:
+            self.debounce_timer = self.parent.w.after(int(self.DEBOUNCE * 1000), self.flush)
+
+    # Queue waiting updates for cmdr, or for all Cmdrs at the end of the debounce interval. Values are recorded as
+    # sent once EDSM has accepted them.
+    def flush(self, cmdr=None):
+        if not cmdr:
+            self.debounce_timer = None
+        for (owner, key) in [x for x in self.debounced if not cmdr or x[0] == cmdr]:
+            (endpoint, fixed, values, outboxkey) = self.debounced.pop((owner, key))
+            digests = {}
+            args = fixed
+            for (name, value) in [(None, fixed)] + values.items():
+                digest = hashlib.sha1(value).hexdigest()
+                if self.digests.get((owner, key, name)) != digest:
+                    digests[(owner, key, name)] = digest
+                    if name:
+                        args += '&%s=%s' % (name, value)
+            if digests:
+                self.enqueue(self._update, endpoint, args, None, digests, key=outboxkey, cmdr=owner)
+            else:
+                self.counters['suppressed'] += 1
 
     def setmaterials(self, raw, manufactured, encoded):
-        self.call('api-commander-v1/set-materials', "&type=data&values=%s" % json.dumps(encoded, separators = (',', ':')))
+        self.debounce('data', 'api-commander-v1/set-materials', '&type=data', [('values', json.dumps(encoded, separators = (',', ':'), sort_keys = True))], 'data')
         materials = {}
         materials.update(raw)
         materials.update(manufactured)
-        self.call('api-commander-v1/set-materials', "&type=materials&values=%s" % json.dumps(materials, separators = (',', ':')))
+        self.debounce('materials', 'api-commander-v1/set-materials', '&type=materials', [('values', json.dumps(materials, separators = (',', ':'), sort_keys = True))], 'materials')
 
     def setshipid(self, shipid):
         if shipid is not None:
-            self.call('api-commander-v1/set-ship-id', '&shipId=%d' % shipid)
+            self.enqueue(self._call, 'api-commander-v1/set-ship-id', '&shipId=%d' % shipid)
 
     def updateship(self, shipid, shiptype, props=[]):
         if shipid is not None and shiptype:
-            args = '&shipId=%d&type=%s' % (shipid, shiptype)
-            for (slot, thing) in props:
-                args += '&%s=%s' % (slot, urllib2.quote(unicode(thing)))
-            self.call('api-commander-v1/update-ship', args)
+            self.debounce('ship%d' % shipid, 'api-commander-v1/update-ship', '&shipId=%d&type=%s' % (shipid, shiptype), [(slot, urllib2.quote(unicode(thing))) for (slot, thing) in props])
 
     def sellship(self, shipid):
         if shipid is not None:
-            self.call('api-commander-v1/sell-ship', '&shipId=%d' % shipid)
+            self.enqueue(self._call, 'api-commander-v1/sell-ship', '&shipId=%d' % shipid)
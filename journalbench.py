@@ -0,0 +1,267 @@
+#!/usr/bin/python
+#
+# Benchmark journal handling by replaying synthetic journals through the monitor and plugins
+#
+
+import argparse
+import gc
+import imp
+import json
+import random
+import shutil
+import sys
+from sys import platform
+import tempfile
+import threading
+from os.path import join
+from time import gmtime, sleep, strftime, time
+
+import monitor
+import plug
+
+if platform != 'win32':
+    import resource
+
+
+# Relative frequency of events in the synthetic journal - roughly that of an exploration & trading session
+MIX = [
+    ('Scan',              30),
+    ('ReceiveText',       12),
+    ('FSDJump',           10),
+    ('MaterialCollected', 10),
+    ('MarketBuy',          6),
+    ('MarketSell',         6),
+    ('Docked',             5),
+    ('Undocked',           5),
+    ('SupercruiseExit',    4),
+    ('SupercruiseEntry',   4),
+    ('MissionAccepted',    3),
+    ('MissionCompleted',   3),
+    ('Cargo',              1),
+    ('Progress',           1),
+]
+
+COMMODITIES = ['gold', 'silver', 'palladium', 'tea', 'coffee', 'biowaste', 'fish', 'grain']
+MATERIALS = [('Raw', 'iron'), ('Raw', 'nickel'), ('Raw', 'carbon'), ('Manufactured', 'heatconductionwiring'), ('Encoded', 'shielddensityreports')]
+
+
+# Generate n lines of synthetic journal. Each line has a 'BenchSeq' property for tracking latency.
+def generate(n, seed=0):
+    rnd = random.Random(seed)
+    events = []
+    for (event, weight) in MIX:
+        events.extend([event] * weight)
+    t = 1496275200	# 2017-06-01
+    cargo = {}
+    missions = []
+    system = 'Sol'
+    lines = []
+
+    def add(event, **props):
+        entry = { 'timestamp': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(t)), 'event': event, 'BenchSeq': len(lines) }
+        entry.update(props)
+        lines.append(json.dumps(entry) + '\n')
+
+    add('Fileheader', part=1, language='English\\UK', gameversion='2.3.10', build='r149869/r0 ')
+    add('Rank', Combat=3, Trade=5, Explore=4, Empire=0, Federation=2, CQC=0)
+    add('Progress', Combat=30, Trade=70, Explore=10, Empire=0, Federation=100, CQC=0)
+    add('Materials', Raw=[{ 'Name': 'iron', 'Count': 10 }], Manufactured=[], Encoded=[])
+    add('Cargo', Inventory=[])
+    add('Loadout', Ship='Asp', ShipID=1, ShipName='Bench', ShipIdent='BN-01', Modules=[{ 'Slot': 'PaintJob', 'Item': 'PaintJob_Asp_Default_01' }])
+    add('LoadGame', Commander='Bench', Ship='Asp', ShipID=1, GameMode='Solo', Credits=1000000, Loan=0)
+    add('Location', Docked=False, StarSystem=system, StarPos=[0.0, 0.0, 0.0], Body='Earth', BodyType='Planet')
+
+    while len(lines) < n:
+        t += rnd.randint(1, 20)
+        event = rnd.choice(events)
+        if event == 'Scan':
+            add(event, BodyName='%s %c %d' % (system, rnd.choice('ABC'), rnd.randint(1, 12)), DistanceFromArrivalLS=rnd.uniform(0, 5000),
+                StarType='K', StellarMass=0.7, Radius=rnd.uniform(1e8, 1e9), AbsoluteMagnitude=6.2, Age_MY=4000, SurfaceTemperature=4500.0,
+                Rings=[{ 'Name': 'Belt', 'RingClass': 'eRingClass_Metalic', 'MassMT': 1e10, 'InnerRad': 1e9, 'OuterRad': 2e9 }])
+        elif event == 'ReceiveText':
+            add(event, From='$npc_name_decorate:#name=Pilot;', Message='$Pirate_OnStartScanCargo07;', Channel='npc')
+        elif event == 'FSDJump':
+            system = 'Bench Sector AB-C d%d' % rnd.randint(1, 9999)
+            add(event, StarSystem=system, StarPos=[rnd.uniform(-100, 100), rnd.uniform(-100, 100), rnd.uniform(-100, 100)],
+                Allegiance='', Economy='$economy_None;', Government='$government_None;', Security='$GAlAXY_MAP_INFO_state_anarchy;',
+                JumpDist=rnd.uniform(5, 40), FuelUsed=rnd.uniform(0.5, 5), FuelLevel=rnd.uniform(5, 32))
+        elif event == 'MaterialCollected':
+            (category, name) = rnd.choice(MATERIALS)
+            add(event, Category=category, Name=name, Count=rnd.randint(1, 3))
+        elif event == 'MarketBuy':
+            commodity = rnd.choice(COMMODITIES)
+            count = rnd.randint(1, 32)
+            cargo[commodity] = cargo.get(commodity, 0) + count
+            add(event, Type=commodity, Count=count, BuyPrice=1000, TotalCost=1000*count)
+        elif event == 'MarketSell' and cargo:
+            commodity = rnd.choice(cargo.keys())
+            count = cargo.pop(commodity)
+            add(event, Type=commodity, Count=count, SellPrice=1100, TotalSale=1100*count, AvgPricePaid=1000)
+        elif event == 'Docked':
+            add(event, StationName='Bench Port', StationType='Coriolis', StarSystem=system, StationFaction='Bench', FactionState='Boom')
+        elif event == 'Undocked':
+            add(event, StationName='Bench Port')
+        elif event == 'SupercruiseExit':
+            add(event, StarSystem=system, Body='%s 1' % system, BodyType='Planet')
+        elif event == 'SupercruiseEntry':
+            add(event, StarSystem=system)
+        elif event == 'MissionAccepted':
+            missions.append(len(lines))
+            add(event, Faction='Bench', Name='Mission_Courier', MissionID=missions[-1], Expiry='2017-07-01T00:00:00Z')
+        elif event == 'MissionCompleted' and missions:
+            add(event, Faction='Bench', Name='Mission_Courier', MissionID=missions.pop(0), Reward=10000)
+        elif event == 'Cargo':
+            add(event, Inventory=[{ 'Name': k, 'Count': v } for (k,v) in cargo.iteritems()])
+        elif event == 'Progress':
+            add(event, Combat=rnd.randint(0, 100), Trade=rnd.randint(0, 100), Explore=rnd.randint(0, 100), Empire=0, Federation=0, CQC=0)
+    return lines[:n]
+
+
+# Memory in use: (max resident set size in KB or None, number of objects tracked by the garbage collector)
+def memory():
+    gc.collect()
+    if platform == 'win32':
+        maxrss = None
+    else:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if platform == 'darwin':
+            maxrss //= 1024	# bytes on OSX
+    return (maxrss, len(gc.get_objects()))
+
+
+def percentile(values, p):
+    return values and sorted(values)[min(len(values)-1, int(len(values) * p / 100.0))] or 0
+
+
+def report(name, count, elapsed, before, after, latencies=None):
+    print '%-10s %8d lines %8.2fs %10.0f lines/s' % (name, count, elapsed, count / (elapsed or 1e-9)),
+    if latencies:
+        print '  latency p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms' % (percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000),
+    print '  memory %s objects %+d' % (before[0] is not None and '%+dKB' % (after[0] - before[0]) or 'n/a', after[1] - before[1])
+
+
+# Decode and parse every line, as on startup
+def bench_parse(lines):
+    edlogs = monitor.EDLogs()
+    before = memory()
+    start = time()
+    for line in lines:
+        edlogs.parse_entry(line)
+    report('parse', len(lines), time() - start, before, memory())
+
+
+# Append lines to a journal file at the given rate (0 = as fast as possible) and time how long it takes for
+# the monitor to deliver them, as the main thread would in response to <<JournalEvent>>
+def bench_tail(lines, rate):
+
+    class Root:
+        # Stand-in for Tk's root window
+        def __init__(self):
+            self.event = threading.Event()
+        def event_generate(self, sequence, when=None):
+            self.event.set()
+
+    logdir = tempfile.mkdtemp()
+    logfile = join(logdir, 'Journal.170601000000.01.log')
+    with open(logfile, 'w') as h:
+        h.write(lines[0])
+
+    root = Root()
+    edlogs = monitor.EDLogs()
+    edlogs.root = root
+    edlogs.currentdir = logdir
+    edlogs.logfile = logfile
+    if getattr(monitor, 'Observer', None):
+        edlogs.observer = monitor.Observer()
+        edlogs.observer.daemon = True
+        edlogs.observer.start()
+        edlogs.observed = edlogs.observer.schedule(edlogs, logdir)
+    edlogs.thread = threading.Thread(target = edlogs.worker, name = 'Journal worker')
+    edlogs.thread.daemon = True
+    edlogs.thread.start()
+    sleep(0.5)	# Let the worker read the Fileheader
+
+    written = [None] * len(lines)
+    def writer():
+        with open(logfile, 'a') as h:
+            start = time()
+            for i in range(1, len(lines)):
+                if rate:
+                    delay = start + i / float(rate) - time()
+                    if delay > 0:
+                        sleep(delay)
+                written[i] = time()
+                h.write(lines[i])
+                h.flush()
+    thread = threading.Thread(target = writer, name = 'Journal writer')
+    thread.daemon = True
+
+    latencies = []
+    before = memory()
+    start = time()
+    thread.start()
+    while len(latencies) < len(lines) - 1 and time() - start < 60 + (rate and len(lines) / float(rate) or 0):
+        root.event.wait(0.1)
+        root.event.clear()
+        for entry in edlogs.get_entries():
+            if entry.get('BenchSeq'):
+                latencies.append(time() - written[entry['BenchSeq']])
+    elapsed = time() - start
+    report('tail', len(latencies), elapsed, before, memory(), latencies)
+
+    # Shut down without saving a checkpoint
+    thread = edlogs.thread
+    edlogs.thread = None
+    edlogs.wakeup.set()
+    thread.join()
+    if edlogs.observer:
+        edlogs.observer.stop()
+        edlogs.observer.join()
+    shutil.rmtree(logdir, ignore_errors=True)
+
+
+# Parse lines and pass them to plugins. Uses n trivial plugins, or the user's installed plugins if n is None.
+def bench_plugins(lines, n):
+    saved = dict(plug.PLUGINS)
+    plug.PLUGINS.clear()
+    if n is None:
+        plug.load_plugins()
+    else:
+        for i in range(n):
+            module = imp.new_module('bench%d' % i)
+            exec 'count = 0\ndef journal_entry(cmdr, system, station, entry, state):\n    global count\n    count += 1\n' in module.__dict__
+            plug.PLUGINS['bench%d' % i] = module
+        plug.index_plugins()
+
+    edlogs = monitor.EDLogs()
+    before = memory()
+    start = time()
+    for line in lines:
+        entry = edlogs.parse_entry(line)
+        plug.notify_journal_entry(edlogs.cmdr, edlogs.system, edlogs.station, entry, edlogs.get_state())
+    report('plugins', len(lines), time() - start, before, memory())
+
+    plug.PLUGINS.clear()
+    plug.PLUGINS.update(saved)
+    plug.index_plugins()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark journal handling with a synthetic journal.')
+    parser.add_argument('-n', '--lines', type=int, default=20000, help='number of journal lines to generate')
+    parser.add_argument('-r', '--rate', type=int, default=0, help='lines per second to write when tailing, or 0 for as fast as possible')
+    parser.add_argument('-p', '--plugins', type=int, default=10, help='number of trivial plugins to load')
+    parser.add_argument('--installed', action='store_true', help='use the installed plugins instead of trivial plugins')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for generating the journal')
+    parser.add_argument('-o', metavar='FILE', help='also write the synthetic journal to FILE')
+    args = parser.parse_args()
+
+    lines = generate(args.lines, args.seed)
+    if args.o:
+        with open(args.o, 'wt') as h:
+            h.writelines(lines)
+
+    bench_parse(lines)
+    bench_tail(lines, args.rate)
+    bench_plugins(lines, None if args.installed else args.plugins)
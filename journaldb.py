@@ -0,0 +1,200 @@
+#!/usr/bin/python
+#
+# Index of historical journal entries in a local SQLite database
+#
+
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import zlib
+from os import listdir
+from os.path import basename, getsize, isdir, join
+
+from config import config
+
+if __debug__:
+    from traceback import print_exc
+
+
+class JournalDB:
+
+    _FILENAME = 'journal.db'	# in config.app_dir
+    SCHEMA_VERSION = 2	# Index is rebuilt if it was created with an earlier schema
+    _POLL = 60	# Interval at which to check the current journal file if not woken by notify() [s]
+
+    SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    name	TEXT PRIMARY KEY,
+    offset	INTEGER NOT NULL,
+    cmdr	TEXT,
+    system	TEXT,
+    station	TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    cmdr	TEXT,
+    timestamp	TEXT NOT NULL,
+    event	TEXT NOT NULL,
+    system	TEXT,
+    station	TEXT,
+    file	TEXT NOT NULL,
+    offset	INTEGER NOT NULL,
+    line	BLOB NOT NULL,
+    UNIQUE (file, offset)
+);
+CREATE INDEX IF NOT EXISTS entries_key ON entries (cmdr, timestamp, event);
+CREATE INDEX IF NOT EXISTS entries_event ON entries (event, timestamp);
+CREATE INDEX IF NOT EXISTS entries_station ON entries (station, event, timestamp);
+'''
+
+    def __init__(self, filename=None):
+        self.filename = filename or join(config.app_dir, self._FILENAME)
+        self.logdir = None
+        self.logfile = None	# Journal file that is being written, as last notified
+        self.rescan = False	# Whether to look for new entries in all journal files
+        self.thread = None
+        self.wakeup = threading.Event()
+
+    def connect(self):
+        # sqlite3 connections can't be shared between threads, so each caller gets its own
+        db = sqlite3.connect(self.filename)
+        if db.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+            db.executescript('DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS files; PRAGMA user_version = %d;' % self.SCHEMA_VERSION)
+        db.executescript(self.SCHEMA)
+        return db
+
+    # Keep the index up to date in the background
+    def start(self, logdir):
+        self.logdir = logdir
+        self.rescan = True
+        if not self.thread or not self.thread.is_alive():
+            self.thread = threading.Thread(target = self.worker, name = 'Journal indexer')
+            self.thread.daemon = True
+            self.thread.start()
+        self.wakeup.set()
+
+    # Called when new journal entries have been seen in logfile. Only that file is read unless it has changed.
+    def notify(self, logfile=None):
+        if logfile != self.logfile:
+            self.logfile = logfile
+            self.rescan = True	# Also pick up the end of the previous file
+        self.wakeup.set()
+
+    def close(self):
+        thread = self.thread
+        self.thread = None	# Orphan the worker thread
+        self.wakeup.set()
+        if thread:
+            thread.join()
+
+    def worker(self):
+        db = self.connect()
+        while True:
+            self.wakeup.wait(self._POLL)
+            self.wakeup.clear()
+            if threading.current_thread() != self.thread:
+                db.close()
+                return	# Terminate
+            try:
+                if self.rescan:
+                    self.rescan = False
+                    self.ingest_dir(db, self.logdir)
+                elif self.logfile:
+                    self.ingest_file(db, self.logfile)
+            except:
+                if __debug__: print_exc()
+
+    # Ingest new entries from all journal files in logdir. Returns number of entries added.
+    def ingest_dir(self, db, logdir):
+        if not logdir or not isdir(logdir):
+            return 0
+        offsets = dict(db.execute('SELECT name, offset FROM files'))
+        count = 0
+        for name in sorted([x for x in listdir(logdir) if x.startswith('Journal.') and x.endswith('.log')]):
+            path = join(logdir, name)
+            if getsize(path) > offsets.get(name, 0):
+                count += self.ingest_file(db, path)
+        return count
+
+    # Ingest entries added to a journal file since it was last ingested. Returns number of entries added.
+    def ingest_file(self, db, path):
+        name = basename(path)
+        row = db.execute('SELECT offset, cmdr, system, station FROM files WHERE name=?', (name,)).fetchone()
+        (offset, cmdr, system, station) = row or (0, None, None, None)
+        rows = []
+        with open(path, 'rb') as h:
+            h.seek(offset)
+            while True:
+                line = h.readline()
+                if not line.endswith('\n'):
+                    break	# Incomplete line - pick it up next time
+                start = offset
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                    event = entry['event']
+                    if event == 'Fileheader':
+                        cmdr = system = station = None
+                    elif event == 'LoadGame':
+                        cmdr = entry['Commander']
+                    elif event == 'NewCommander':
+                        cmdr = entry['Name']
+                    elif event in ['Location', 'FSDJump', 'Docked']:
+                        system = entry['StarSystem']
+                        station = entry.get('StationName')
+                    elif event == 'Undocked':
+                        station = None
+                    rows.append((cmdr, entry['timestamp'], event, system, station, name, start, sqlite3.Binary(zlib.compress(line.strip()))))
+                except:
+                    if __debug__:
+                        print 'Invalid journal entry "%s"' % repr(line)
+        with db:	# One transaction per file
+            changes = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO entries VALUES (?,?,?,?,?,?,?,?)', rows)	# Ignore entries already added, e.g. if interrupted
+            changes = db.total_changes - changes
+            db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)', (name, offset, cmdr, system, station))
+        return changes
+
+    # Generator for matching journal entries, in timestamp order. Timestamps are in journal format, e.g.
+    # query(event='FSDJump', start='2017-06-01T00:00:00Z', end='2017-07-01T00:00:00Z') or
+    # query(event='MarketSell', station='Jameson Memorial')
+    def query(self, event=None, cmdr=None, start=None, end=None, system=None, station=None):
+        where = []
+        args = []
+        for (clause, arg) in [('event=?', event), ('cmdr=?', cmdr), ('timestamp>=?', start), ('timestamp<?', end), ('system=?', system), ('station=?', station)]:
+            if arg is not None:
+                where.append(clause)
+                args.append(arg)
+        db = self.connect()
+        try:
+            for (line,) in db.execute('SELECT line FROM entries%s ORDER BY timestamp' % (where and ' WHERE ' + ' AND '.join(where) or ''), args):
+                yield json.loads(zlib.decompress(str(line)), object_pairs_hook=OrderedDict)
+        finally:
+            db.close()
+
+
+#
+# Update and query the index from the command line
+#
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Index and query E:D journal files.')
+    parser.add_argument('-u', '--update', metavar='DIR', nargs='?', const=config.get('journaldir') or config.default_journal_dir, help='ingest new entries from the journal files in DIR, by default the configured journal folder')
+    parser.add_argument('--event', help='entries of this type')
+    parser.add_argument('--cmdr', help='entries for this Cmdr')
+    parser.add_argument('--from', dest='start', metavar='TIMESTAMP', help='entries at or after TIMESTAMP, e.g. 2017-06-01T00:00:00Z')
+    parser.add_argument('--to', dest='end', metavar='TIMESTAMP', help='entries before TIMESTAMP')
+    parser.add_argument('--system', help='entries in this system')
+    parser.add_argument('--station', help='entries while docked at this station')
+    args = parser.parse_args()
+
+    journaldb = JournalDB()
+    if args.update:
+        db = journaldb.connect()
+        print 'Added %d entries' % journaldb.ingest_dir(db, args.update)
+        db.close()
+    if args.event or args.cmdr or args.start or args.end or args.system or args.station:
+        for entry in journaldb.query(args.event, args.cmdr, args.start, args.end, args.system, args.station):
+            print json.dumps(entry)
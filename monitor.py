@@ -1,14 +1,15 @@
 import atexit
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
+import cPickle
 import json
 import re
 import threading
-from os import listdir, pardir, rename, unlink, SEEK_SET, SEEK_CUR, SEEK_END
-from os.path import basename, exists, isdir, isfile, join
+from os import fstat, listdir, pardir, rename, stat, unlink, SEEK_SET, SEEK_CUR, SEEK_END
+from os.path import basename, exists, isdir, isfile, join, realpath
 from platform import machine
 import sys
 from sys import platform
-from time import gmtime, sleep, strftime
+from time import gmtime, strftime, time
 
 if __debug__:
     from traceback import print_exc
@@ -24,6 +25,64 @@ def tagsymbol(tag):
         return tag.lower()
 
 
+class FrozenDict(dict):
+    # Read-only dict, for passing the monitor's state to consumers. Like a defaultdict if default_factory is given.
+    # version is increased each time that the monitor's state changes, so that consumers can tell whether it has.
+
+    __slots__ = ('default_factory', 'version')
+
+    def __init__(self, items=(), default_factory=None, version=0):
+        dict.__init__(self, items)
+        self.default_factory = default_factory
+        self.version = version
+
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        return self.default_factory()	# but don't store it
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('state is read-only - use copy() to get a modifiable copy')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), self.default_factory, self.version))
+
+
+class FrozenList(list):
+    # Read-only list, for passing the monitor's state to consumers
+
+    __slots__ = ()
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError('state is read-only - use list() to get a modifiable copy')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = __readonly
+    append = extend = insert = pop = remove = reverse = sort = __readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze(value, old=None):
+    # Read-only copy of value. Reuses old, the previous read-only copy, and the parts of it that are unchanged.
+    if isinstance(value, dict):
+        if isinstance(old, FrozenDict) and old == value:
+            return old
+        if not isinstance(old, dict):
+            old = {}
+        return FrozenDict([(k, freeze(v, old.get(k))) for (k, v) in value.iteritems()], getattr(value, 'default_factory', None))
+    elif isinstance(value, list):
+        if isinstance(old, FrozenList) and old == value:
+            return old
+        if not isinstance(old, list):
+            old = []
+        return FrozenList([freeze(x, i < len(old) and old[i] or None) for (i, x) in enumerate(value)])
+    else:
+        return value
+
+
 if platform=='darwin':
     from AppKit import NSWorkspace
     from Foundation import NSSearchPathForDirectoriesInDomains, NSApplicationSupportDirectory, NSUserDomainMask
@@ -74,13 +133,62 @@ elif platform=='win32':
     GetProcessHandleFromHwnd = ctypes.windll.oleacc.GetProcessHandleFromHwnd
 
 else:
-    # Linux's inotify doesn't work over CIFS or NFS, so poll
-    FileSystemEventHandler = object	# dummy
+    # Use inotify for local filesystems. Linux's inotify doesn't work over CIFS or NFS, so poll those.
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        Observer = None
+        FileSystemEventHandler = object	# dummy
+
+    # Filesystem types on which inotify doesn't report changes made by other hosts
+    NETWORK_FS = set(['9p', 'afs', 'cifs', 'coda', 'davfs', 'ncpfs', 'nfs', 'nfs4', 'smb3', 'smbfs', 'fuse.sshfs', 'fuse.vmhgfs-fuse', 'vboxsf'])
+
+    def is_network_path(path):
+        # Find the filesystem type of the longest mount point that contains path
+        path = realpath(path)
+        fstype = None
+        longest = -1
+        try:
+            with open('/proc/mounts') as h:
+                for line in h:
+                    fields = line.split()
+                    if len(fields) < 3:
+                        continue
+                    mountpoint = fields[1].replace('\\040', ' ')
+                    if (path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/')) and len(mountpoint) > longest:
+                        longest = len(mountpoint)
+                        fstype = fields[2]
+        except:
+            if __debug__: print_exc()
+            return True	# Can't tell, so assume the worst
+        return fstype in NETWORK_FS
+
+
+# Journal event name -> functions(monitor, entry) that update the monitor's state. Populated at import.
+_handlers = {}
+
+def handles(*events):
+    # Decorator for EDLogs methods that handle the named journal events
+    def register(func):
+        for event in events:
+            _handlers.setdefault(event, []).append(func)
+        return func
+    return register
+
+# Journal event name -> functions(monitor, entry) registered by plugins. These maintain the plugins' own state.
+_plugin_handlers = {}
 
 
 class EDLogs(FileSystemEventHandler):
 
-    _POLL = 1		# Polling is cheap, so do it often
+    _POLL = 1		# Polling is cheap, so do it often. Also the fallback wakeup interval when watching.
+    _RESCAN = 15	# Maximum interval between directory scans when polling [s]
+    _QUEUE_MAX = 1000	# Stop reading the journal while this many lines are waiting for the main thread
+    _CHECKPOINT = 'monitor.p'	# Saved state in config.app_dir
+
+    # Journal context that is saved along with self.state
+    CONTEXT = ['version', 'is_beta', 'mode', 'group', 'cmdr', 'captain', 'role', 'body', 'system', 'station', 'coordinates']
 
     # Mostly taken from http://elite-dangerous.wikia.com/wiki/List_of_Rare_Commodities
     RARES = set([
@@ -120,7 +228,10 @@ class EDLogs(FileSystemEventHandler):
         self.observer = None
         self.observed = None		# a watchdog ObservedWatch, or None if polling
         self.thread = None
-        self.event_queue = []		# For communicating journal entries back to main thread
+        self.wakeup = threading.Event()	# Set by watchdog callbacks to wake the worker thread
+        self.logpos = None		# (logfile, offset) up to which lines have been read by the worker thread
+        self.event_queue = deque()	# For communicating journal entries back to main thread. Thread-safe for append & popleft.
+        self.backlogged = False		# Worker thread has stopped reading because event_queue is full
 
         # On startup we might be:
         # 1) Looking at an old journal file because the game isn't running or the user has exited to the main menu.
@@ -143,6 +254,8 @@ class EDLogs(FileSystemEventHandler):
         self.station = None
         self.coordinates = None
         self.state = {}		# Initialized in Fileheader
+        self.snapshot = None	# Read-only copy of state. See get_state().
+        self.stale = True	# state has changed since snapshot was taken
 
         # Cmdr state shared with EDSM and plugins
         self.state = {
@@ -179,17 +292,22 @@ class EDLogs(FileSystemEventHandler):
         # Latest pre-existing logfile - e.g. if E:D is already running. Assumes logs sort alphabetically.
         # Do this before setting up the observer in case the journal directory has gone away
         try:
-            logfiles = sorted([x for x in listdir(self.currentdir) if x.startswith('Journal.') and x.endswith('.log')])
-            self.logfile = logfiles and join(self.currentdir, logfiles[-1]) or None
+            logfiles = [x for x in listdir(self.currentdir) if x.startswith('Journal.') and x.endswith('.log')]
+            self.logfile = logfiles and join(self.currentdir, max(logfiles)) or None
         except:
             self.logfile = None
             return False
 
         # Set up a watchog observer. This is low overhead so is left running irrespective of whether monitoring is desired.
         # File system events are unreliable/non-existent over network drives on Linux.
-        # We can't easily tell whether a path points to a network drive, so assume
-        # any non-standard logdir might be on a network drive and poll instead.
-        polling = bool(config.get('journaldir')) and platform != 'win32'
+        # On Linux we can tell whether a path points to a network drive. Elsewhere we can't easily tell,
+        # so assume any non-standard logdir might be on a network drive and poll instead.
+        if platform == 'win32':
+            polling = False
+        elif platform == 'darwin':
+            polling = bool(config.get('journaldir'))
+        else:
+            polling = not Observer or is_network_path(self.currentdir)
         if not polling and not self.observer:
             self.observer = Observer()
             self.observer.daemon = True
@@ -219,15 +337,18 @@ class EDLogs(FileSystemEventHandler):
             self.observed = None
             self.observer.unschedule_all()
         self.thread = None	# Orphan the worker thread - will terminate at next poll
+        self.wakeup.set()
 
     def close(self):
         thread = self.thread
-        self.stop()
-        if self.observer:
-            self.observer.stop()
+        self.thread = None	# Orphan the worker thread
+        self.wakeup.set()
         if thread:
             thread.join()
+        self.checkpoint()
+        self.stop()
         if self.observer:
+            self.observer.stop()
             self.observer.join()
             self.observer = None
 
@@ -247,6 +368,12 @@ class EDLogs(FileSystemEventHandler):
         # watchdog callback, e.g. client (re)started.
         if not event.is_directory and basename(event.src_path).startswith('Journal.') and basename(event.src_path).endswith('.log'):
             self.logfile = event.src_path
+            self.wakeup.set()
+
+    def on_modified(self, event):
+        # watchdog callback - new journal entries
+        if not event.is_directory and event.src_path == self.logfile:
+            self.wakeup.set()
 
     def worker(self):
         # Tk isn't thread-safe in general.
@@ -257,12 +384,14 @@ class EDLogs(FileSystemEventHandler):
         logfile = self.logfile
         if logfile:
             loghandle = open(logfile, 'r')
-            for line in loghandle:
+            self.restore(logfile, loghandle)	# Skip what we've seen before, if we can
+            for line in self.readlines(loghandle):
                 try:
                     self.parse_entry(line)	# Some events are of interest even in the past
                 except:
                     if __debug__:
                         print 'Invalid journal entry "%s"' % repr(line)
+            self.logpos = (logfile, loghandle.tell())
         else:
             loghandle = None
 
@@ -276,42 +405,143 @@ class EDLogs(FileSystemEventHandler):
         # Watchdog thread
         emitter = self.observed and self.observer._emitter_for_watch[self.observed]	# Note: Uses undocumented attribute
 
+        dirmtime = None
+        lastscan = 0
+
         while True:
 
             # Check whether new log file started, e.g. client (re)started.
             if emitter and emitter.is_alive():
                 newlogfile = self.logfile	# updated by on_created watchdog callback
             else:
-                # Poll
+                # Poll. Only rescan the directory when its contents have changed, or occasionally in case
+                # the network filesystem is caching the directory's attributes.
                 try:
-                    logfiles = sorted([x for x in listdir(self.currentdir) if x.startswith('Journal.') and x.endswith('.log')])
-                    newlogfile = logfiles and join(self.currentdir, logfiles[-1]) or None
+                    newdirmtime = stat(self.currentdir).st_mtime
+                    if newdirmtime != dirmtime or time() - lastscan >= self._RESCAN:
+                        dirmtime = newdirmtime
+                        lastscan = time()
+                        logfiles = [x for x in listdir(self.currentdir) if x.startswith('Journal.') and x.endswith('.log')]
+                        self.logfile = logfiles and join(self.currentdir, max(logfiles)) or None	# Assumes logs sort alphabetically
+                    newlogfile = self.logfile
                 except:
                     if __debug__: print_exc()
                     newlogfile = None
 
-            if logfile != newlogfile:
-                logfile = newlogfile
+            # Finish queueing anything written to the old file before the switch
+            if logfile != newlogfile and (not loghandle or self.queuelines(loghandle)):
                 if loghandle:
                     loghandle.close()
+                logfile = newlogfile
                 if logfile:
                     loghandle = open(logfile, 'r')
+                else:
+                    loghandle = None
                 if __debug__:
                     print 'New logfile "%s"' % logfile
 
             if logfile:
-                loghandle.seek(0, SEEK_CUR)	# reset EOF flag
-                for line in loghandle:
-                    self.event_queue.append(line)
+                self.queuelines(loghandle)
+                self.logpos = (logfile, loghandle.tell())
                 if self.event_queue:
                     self.root.event_generate('<<JournalEvent>>', when="tail")
 
-            sleep(self._POLL)
+            self.wakeup.wait(self._POLL)	# until on_modified, on_created or event_queue drained
+            self.wakeup.clear()
 
             # Check whether we're still supposed to be running
             if threading.current_thread() != self.thread:
                 return	# Terminate
 
+    def readlines(self, loghandle):
+        # Complete lines appended to the log file since the last read
+        loghandle.seek(0, SEEK_CUR)	# reset EOF flag
+        while True:
+            line = loghandle.readline()
+            if not line.endswith('\n'):
+                loghandle.seek(-len(line), SEEK_CUR)	# Incomplete line - wait for the game to finish writing it
+                return
+            yield line
+
+    def queuelines(self, loghandle):
+        # Queue new lines for the main thread, up to _QUEUE_MAX. Returns False if there may be more to read.
+        for line in self.readlines(loghandle):
+            self.event_queue.append(line)
+            if len(self.event_queue) >= self._QUEUE_MAX:
+                self.backlogged = True	# Leave the rest in the file until the main thread catches up
+                return False
+        return True
+
+    def restore(self, logfile, loghandle):
+        # Restore state saved by checkpoint() and seek to where it left off, if logfile is unchanged since then.
+        # Otherwise leave loghandle at the start of the file.
+        filename = join(config.app_dir, self._CHECKPOINT)
+        if not isfile(filename):
+            return False
+        try:
+            with open(filename, 'rb') as h:
+                checkpoint = cPickle.load(h)
+            header = loghandle.readline()	# Fileheader has a timestamp, so guards against file systems without inodes
+            info = fstat(loghandle.fileno())
+            if (checkpoint['logfile'] != logfile or
+                checkpoint['inode'] != info.st_ino or
+                checkpoint['header'] != header or
+                not len(header) <= checkpoint['offset'] <= info.st_size):
+                loghandle.seek(0, SEEK_SET)
+                return False
+            for attr in self.CONTEXT:
+                setattr(self, attr, checkpoint[attr])
+            self.state = checkpoint['state']
+            self.stale = True
+            self.live = self.cmdr is not None	# i.e. we've seen LoadGame since Fileheader
+            if _plugin_handlers:
+                self.replay(loghandle, checkpoint['offset'])
+            loghandle.seek(checkpoint['offset'], SEEK_SET)
+            if __debug__:
+                print 'Resuming logfile "%s" at %d' % (logfile, checkpoint['offset'])
+            return True
+        except:
+            if __debug__: print_exc()
+            loghandle.seek(0, SEEK_SET)
+            return False
+
+    def replay(self, loghandle, offset):
+        # Plugins' state isn't saved, so pass them the entries up to offset that we skipped over. Note that the
+        # monitor's state is already as at offset.
+        loghandle.seek(0, SEEK_SET)
+        while loghandle.tell() < offset:
+            line = loghandle.readline()
+            try:
+                entry = json.loads(line, object_pairs_hook=OrderedDict)
+                for handler in _plugin_handlers.get(entry['event'], []):
+                    handler(self, entry)
+            except:
+                if __debug__:
+                    print 'Invalid journal entry "%s"' % repr(line)
+
+    def checkpoint(self):
+        # Save state and position in the journal. Should only be called once the worker thread has stopped.
+        if not self.logpos:
+            return
+        (logfile, offset) = self.logpos
+        for entry in self.get_entries():
+            pass	# Bring state up to date with offset
+        filename = join(config.app_dir, self._CHECKPOINT)
+        try:
+            with open(logfile, 'r') as h:
+                header = h.readline()
+                inode = fstat(h.fileno()).st_ino
+            checkpoint = { 'logfile': logfile, 'inode': inode, 'header': header, 'offset': offset, 'state': self.state }
+            for attr in self.CONTEXT:
+                checkpoint[attr] = getattr(self, attr)
+            with open(filename + '.tmp', 'wb') as h:
+                cPickle.dump(checkpoint, h, cPickle.HIGHEST_PROTOCOL)
+            if exists(filename):
+                unlink(filename)	# Windows can't rename over an existing file
+            rename(filename + '.tmp', filename)
+        except:
+            if __debug__: print_exc()
+
     def parse_entry(self, line):
         if line is None:
             return { 'event': None }	# Fake startup event
@@ -319,163 +549,13 @@ class EDLogs(FileSystemEventHandler):
         try:
             entry = json.loads(line, object_pairs_hook=OrderedDict)	# Preserve property order because why not?
             entry['timestamp']	# we expect this to exist
-            if entry['event'] == 'Fileheader':
-                self.live = False
-                self.version = entry['gameversion']
-                self.is_beta = 'beta' in entry['gameversion'].lower()
-                self.cmdr = None
-                self.mode = None
-                self.group = None
-                self.captain = None
-                self.role = None
-                self.body = None
-                self.system = None
-                self.station = None
-                self.coordinates = None
-                self.state = {
-                    'Cargo'        : defaultdict(int),
-                    'Credits'      : None,
-                    'Loan'         : None,
-                    'Raw'          : defaultdict(int),
-                    'Manufactured' : defaultdict(int),
-                    'Encoded'      : defaultdict(int),
-                    'PaintJob'     : None,
-                    'Rank'         : { 'Combat': None, 'Trade': None, 'Explore': None, 'Empire': None, 'Federation': None, 'CQC': None },
-                    'ShipID'       : None,
-                    'ShipIdent'    : None,
-                    'ShipName'     : None,
-                    'ShipType'     : None,
-                    'Missions'     : dict(),
-                }
-            elif entry['event'] == 'LoadGame':
-                self.live = True
-                self.cmdr = entry['Commander']
-                self.mode = entry.get('GameMode')	# 'Open', 'Solo', 'Group', or None for CQC (and Training - but no LoadGame event)
-                self.group = entry.get('Group')
-                self.captain = None
-                self.role = None
-                self.body = None
-                self.system = None
-                self.station = None
-                self.coordinates = None
-                self.state.update({
-                    'Credits'      : entry['Credits'],
-                    'Loan'         : entry['Loan'],
-                    'Rank'         : { 'Combat': None, 'Trade': None, 'Explore': None, 'Empire': None, 'Federation': None, 'CQC': None },
-                })
-            elif entry['event'] == 'NewCommander':
-                self.cmdr = entry['Name']
-                self.group = None
-            elif entry['event'] == 'SetUserShipName':
-                self.state['ShipID']    = entry['ShipID']
-                if 'UserShipId' in entry:	# Only present when changing the ship's ident
-                    self.state['ShipIdent'] = entry['UserShipId']
-                self.state['ShipName']  = entry.get('UserShipName')
-                self.state['ShipType']  = entry['Ship'].lower()
-            elif entry['event'] == 'ShipyardBuy':
-                self.state['ShipID'] = None
-                self.state['ShipIdent'] = None
-                self.state['ShipName']  = None
-                self.state['ShipType'] = entry['ShipType'].lower()
-                self.state['PaintJob'] = None
-            elif entry['event'] == 'ShipyardSwap':
-                self.state['ShipID'] = entry['ShipID']
-                self.state['ShipIdent'] = None
-                self.state['ShipName']  = None
-                self.state['ShipType'] = entry['ShipType'].lower()
-                self.state['PaintJob'] = None
-            elif entry['event'] == 'Loadout':	# Note: Precedes LoadGame, ShipyardNew, follows ShipyardSwap, ShipyardBuy
-                self.state['ShipID'] = entry['ShipID']
-                self.state['ShipIdent'] = entry['ShipIdent']
-                self.state['ShipName']  = entry['ShipName']
-                self.state['ShipType']  = entry['Ship'].lower()
-                # Ignore other Modules since they're missing Engineer modification details
-                self.state['PaintJob'] = ''
-                for module in entry['Modules']:
-                    if module.get('Slot') == 'PaintJob' and module.get('Item'):
-                        self.state['PaintJob'] = module['Item'].lower()
-            elif entry['event'] in ['ModuleBuy', 'ModuleSell'] and entry['Slot'] == 'PaintJob':
-                self.state['PaintJob'] = tagsymbol(entry.get('BuyItem', ''))
-            elif entry['event'] in ['Undocked']:
-                self.station = None
-            elif entry['event'] in ['Location', 'FSDJump', 'Docked']:
-                if entry['event'] != 'Docked':
-                    self.body = None
-                if 'StarPos' in entry:
-                    self.coordinates = tuple(entry['StarPos'])
-                elif self.system != entry['StarSystem']:
-                    self.coordinates = None	# Docked event doesn't include coordinates
-                self.system = entry['StarSystem'] == 'ProvingGround' and 'CQC' or entry['StarSystem']
-                self.station = entry.get('StationName')	# May be None
-            elif entry['event'] == 'SupercruiseExit':
-                self.body = entry.get('BodyType') == 'Planet' and entry.get('Body')
-            elif entry['event'] == 'SupercruiseEntry':
-                self.body = None
-            elif entry['event'] in ['Rank', 'Promotion']:
-                for k,v in entry.iteritems():
-                    if k in self.state['Rank']:
-                        self.state['Rank'][k] = (v,0)
-            elif entry['event'] == 'Progress':
-                for k,v in entry.iteritems():
-                    if self.state['Rank'].get(k) is not None:
-                        self.state['Rank'][k] = (self.state['Rank'][k][0], min(v, 100))	# perhaps not taken promotion mission yet
-
-            elif entry['event'] == 'Cargo':
-                self.live = True	# First event in 2.3
-                self.state['Cargo'] = defaultdict(int)
-                self.state['Cargo'].update({ x['Name']: x['Count'] for x in entry['Inventory'] })
-            elif entry['event'] in ['CollectCargo', 'MarketBuy', 'MiningRefined', 'PowerplayCollect', 'BuyDrones']:
-                self.add_cargo(entry['Type'], entry.get('Count', 1))
-            elif entry['event'] in ['EjectCargo', 'MarketSell', 'PowerplayDeliver', 'SellDrones']:
-                self.add_cargo(entry['Type'], -entry.get('Count', 1))
-            elif entry['event'] == 'MissionAccepted':
-                self.state['Missions'][entry['MissionID']] = entry
-                if entry['Name'].split('_')[1:2] == ['Delivery']:
-                    self.add_cargo(entry['Commodity'], entry.get('Count', 1))
-            elif entry['event'] == 'MissionCompleted':
-                oldmission = self.state['Missions'].pop(entry['MissionID'], None)
-                missiontype = entry['Name'].split('_')
-                if len(missiontype)>1 and missiontype[1] in ['Delivery', 'Collect']:
-                    self.add_cargo(entry['Commodity'], -entry.get('Count', 1))
-                # Not sure whether the names for 'CommodityReward' are from the same namespace as the 'Cargo' event.
-                for reward in entry.get('CommodityReward', []):
-                    self.add_cargo(reward['Name'].lower(), reward.get('Count', 1))
-
-            elif entry['event'] == 'Materials':
-                for category in ['Raw', 'Manufactured', 'Encoded']:
-                    self.state[category] = defaultdict(int)
-                    self.state[category].update({ x['Name']: x['Count'] for x in entry.get(category, []) })
-            elif entry['event'] == 'MaterialCollected':
-                self.state[entry['Category']][entry['Name']] += entry['Count']
-            elif entry['event'] in ['MaterialDiscarded', 'ScientificResearch']:
-                self.state[entry['Category']][entry['Name']] -= entry['Count']
-                if self.state[entry['Category']][entry['Name']] <= 0:
-                    self.state[entry['Category']].pop(entry['Name'])
-            elif entry['event'] in ['EngineerCraft', 'Synthesis']:
-                for category in ['Raw', 'Manufactured', 'Encoded']:
-                    for x in entry[entry['event'] == 'EngineerCraft' and 'Ingredients' or 'Materials']:
-                        if x['Name'] in self.state[category]:
-                            self.state[category][x['Name']] -= x['Count']
-                            if self.state[category][x['Name']] <= 0:
-                                self.state[category].pop(x['Name'])
-
-            elif entry['event'] == 'JoinACrew':
-                self.captain = entry['Captain']
-                self.role = None
-                self.body = None
-                self.system = None
-                self.station = None
-                self.coordinates = None
-            elif entry['event'] == 'ChangeCrewRole':
-                self.role = entry['Role'] != 'Idle' and entry['Role'] or None
-            elif entry['event'] == 'QuitACrew':
-                self.captain = None
-                self.role = None
-                self.body = None
-                self.system = None
-                self.station = None
-                self.coordinates = None
-
+            handlers = _handlers.get(entry['event'])
+            if handlers:	# Most events don't affect our state
+                self.stale = True
+                for handler in handlers:
+                    handler(self, entry)
+            for handler in _plugin_handlers.get(entry['event'], []):
+                handler(self, entry)	# Doesn't affect our state
             return entry
         except:
             if __debug__:
@@ -483,15 +563,264 @@ class EDLogs(FileSystemEventHandler):
                 print_exc()
             return { 'event': None }
 
+    def get_state(self):
+        # Read-only copy of state, shared by all consumers until state next changes. Parts of the state
+        # that haven't changed are shared with the previous copy. Its version is increased if anything changed.
+        if self.stale:
+            snapshot = freeze(self.state, self.snapshot)
+            if snapshot is not self.snapshot:
+                snapshot.version = self.snapshot is not None and self.snapshot.version + 1 or 1
+                self.snapshot = snapshot
+            self.stale = False
+        return self.snapshot
+
+    def state_changed(self):
+        # Must be called after modifying state other than from a journal event handler
+        self.stale = True
+
+    def register_handler(self, event, func):
+        # Allow plugins to maintain their own state. func(monitor, entry) is called for each journal entry of the
+        # given type, after the monitor has updated its own state. Entries read while catching up with the journal
+        # on startup are handled on the worker thread, and later entries on the main thread, so func mustn't use Tk.
+        def handler(monitor, entry):
+            try:
+                func(monitor, entry)
+            except:
+                if __debug__: print_exc()	# Don't let a plugin's error affect the monitor's state
+        _plugin_handlers.setdefault(event, []).append(handler)
+
+    # Journal event handlers
+
+    @handles('Fileheader')
+    def _fileheader(self, entry):
+        self.live = False
+        self.version = entry['gameversion']
+        self.is_beta = 'beta' in entry['gameversion'].lower()
+        self.cmdr = None
+        self.mode = None
+        self.group = None
+        self.captain = None
+        self.role = None
+        self.body = None
+        self.system = None
+        self.station = None
+        self.coordinates = None
+        self.state = {
+            'Cargo'        : defaultdict(int),
+            'Credits'      : None,
+            'Loan'         : None,
+            'Raw'          : defaultdict(int),
+            'Manufactured' : defaultdict(int),
+            'Encoded'      : defaultdict(int),
+            'PaintJob'     : None,
+            'Rank'         : { 'Combat': None, 'Trade': None, 'Explore': None, 'Empire': None, 'Federation': None, 'CQC': None },
+            'ShipID'       : None,
+            'ShipIdent'    : None,
+            'ShipName'     : None,
+            'ShipType'     : None,
+            'Missions'     : dict(),
+        }
+
+    @handles('LoadGame')
+    def _loadgame(self, entry):
+        self.live = True
+        self.cmdr = entry['Commander']
+        self.mode = entry.get('GameMode')	# 'Open', 'Solo', 'Group', or None for CQC (and Training - but no LoadGame event)
+        self.group = entry.get('Group')
+        self.captain = None
+        self.role = None
+        self.body = None
+        self.system = None
+        self.station = None
+        self.coordinates = None
+        self.state.update({
+            'Credits'      : entry['Credits'],
+            'Loan'         : entry['Loan'],
+            'Rank'         : { 'Combat': None, 'Trade': None, 'Explore': None, 'Empire': None, 'Federation': None, 'CQC': None },
+        })
+
+    @handles('NewCommander')
+    def _newcommander(self, entry):
+        self.cmdr = entry['Name']
+        self.group = None
+
+    @handles('SetUserShipName')
+    def _setusershipname(self, entry):
+        self.state['ShipID']    = entry['ShipID']
+        if 'UserShipId' in entry:	# Only present when changing the ship's ident
+            self.state['ShipIdent'] = entry['UserShipId']
+        self.state['ShipName']  = entry.get('UserShipName')
+        self.state['ShipType']  = entry['Ship'].lower()
+
+    @handles('ShipyardBuy')
+    def _shipyardbuy(self, entry):
+        self.state['ShipID'] = None
+        self.state['ShipIdent'] = None
+        self.state['ShipName']  = None
+        self.state['ShipType'] = entry['ShipType'].lower()
+        self.state['PaintJob'] = None
+
+    @handles('ShipyardSwap')
+    def _shipyardswap(self, entry):
+        self.state['ShipID'] = entry['ShipID']
+        self.state['ShipIdent'] = None
+        self.state['ShipName']  = None
+        self.state['ShipType'] = entry['ShipType'].lower()
+        self.state['PaintJob'] = None
+
+    @handles('Loadout')	# Note: Precedes LoadGame, ShipyardNew, follows ShipyardSwap, ShipyardBuy
+    def _loadout(self, entry):
+        self.state['ShipID'] = entry['ShipID']
+        self.state['ShipIdent'] = entry['ShipIdent']
+        self.state['ShipName']  = entry['ShipName']
+        self.state['ShipType']  = entry['Ship'].lower()
+        # Ignore other Modules since they're missing Engineer modification details
+        self.state['PaintJob'] = ''
+        for module in entry['Modules']:
+            if module.get('Slot') == 'PaintJob' and module.get('Item'):
+                self.state['PaintJob'] = module['Item'].lower()
+
+    @handles('ModuleBuy', 'ModuleSell')
+    def _modulebuy(self, entry):
+        if entry['Slot'] == 'PaintJob':
+            self.state['PaintJob'] = tagsymbol(entry.get('BuyItem', ''))
+
+    @handles('Undocked')
+    def _undocked(self, entry):
+        self.station = None
+
+    @handles('Location', 'FSDJump', 'Docked')
+    def _location(self, entry):
+        if entry['event'] != 'Docked':
+            self.body = None
+        if 'StarPos' in entry:
+            self.coordinates = tuple(entry['StarPos'])
+        elif self.system != entry['StarSystem']:
+            self.coordinates = None	# Docked event doesn't include coordinates
+        self.system = entry['StarSystem'] == 'ProvingGround' and 'CQC' or entry['StarSystem']
+        self.station = entry.get('StationName')	# May be None
+
+    @handles('SupercruiseExit')
+    def _supercruiseexit(self, entry):
+        self.body = entry.get('BodyType') == 'Planet' and entry.get('Body')
+
+    @handles('SupercruiseEntry')
+    def _supercruiseentry(self, entry):
+        self.body = None
+
+    @handles('Rank', 'Promotion')
+    def _rank(self, entry):
+        for k,v in entry.iteritems():
+            if k in self.state['Rank']:
+                self.state['Rank'][k] = (v,0)
+
+    @handles('Progress')
+    def _progress(self, entry):
+        for k,v in entry.iteritems():
+            if self.state['Rank'].get(k) is not None:
+                self.state['Rank'][k] = (self.state['Rank'][k][0], min(v, 100))	# perhaps not taken promotion mission yet
+
+    @handles('Cargo')
+    def _cargo(self, entry):
+        self.live = True	# First event in 2.3
+        self.state['Cargo'] = defaultdict(int)
+        self.state['Cargo'].update({ x['Name']: x['Count'] for x in entry['Inventory'] })
+
+    @handles('CollectCargo', 'MarketBuy', 'MiningRefined', 'PowerplayCollect', 'BuyDrones')
+    def _collectcargo(self, entry):
+        self.add_cargo(entry['Type'], entry.get('Count', 1))
+
+    @handles('EjectCargo', 'MarketSell', 'PowerplayDeliver', 'SellDrones')
+    def _ejectcargo(self, entry):
+        self.add_cargo(entry['Type'], -entry.get('Count', 1))
+
+    @handles('MissionAccepted')
+    def _missionaccepted(self, entry):
+        self.state['Missions'][entry['MissionID']] = entry
+        if entry['Name'].split('_')[1:2] == ['Delivery']:
+            self.add_cargo(entry['Commodity'], entry.get('Count', 1))
+
+    @handles('MissionCompleted')
+    def _missioncompleted(self, entry):
+        oldmission = self.state['Missions'].pop(entry['MissionID'], None)
+        missiontype = entry['Name'].split('_')
+        if len(missiontype)>1 and missiontype[1] in ['Delivery', 'Collect']:
+            self.add_cargo(entry['Commodity'], -entry.get('Count', 1))
+        # Not sure whether the names for 'CommodityReward' are from the same namespace as the 'Cargo' event.
+        for reward in entry.get('CommodityReward', []):
+            self.add_cargo(reward['Name'].lower(), reward.get('Count', 1))
+
+    @handles('Materials')
+    def _materials(self, entry):
+        for category in ['Raw', 'Manufactured', 'Encoded']:
+            self.state[category] = defaultdict(int)
+            self.state[category].update({ x['Name']: x['Count'] for x in entry.get(category, []) })
+
+    @handles('MaterialCollected')
+    def _materialcollected(self, entry):
+        self.state[entry['Category']][entry['Name']] += entry['Count']
+
+    @handles('MaterialDiscarded', 'ScientificResearch')
+    def _materialdiscarded(self, entry):
+        self.state[entry['Category']][entry['Name']] -= entry['Count']
+        if self.state[entry['Category']][entry['Name']] <= 0:
+            self.state[entry['Category']].pop(entry['Name'])
+
+    @handles('EngineerCraft', 'Synthesis')
+    def _engineercraft(self, entry):
+        for category in ['Raw', 'Manufactured', 'Encoded']:
+            for x in entry[entry['event'] == 'EngineerCraft' and 'Ingredients' or 'Materials']:
+                if x['Name'] in self.state[category]:
+                    self.state[category][x['Name']] -= x['Count']
+                    if self.state[category][x['Name']] <= 0:
+                        self.state[category].pop(x['Name'])
+
+    @handles('JoinACrew')
+    def _joinacrew(self, entry):
+        self.captain = entry['Captain']
+        self.role = None
+        self.body = None
+        self.system = None
+        self.station = None
+        self.coordinates = None
+
+    @handles('ChangeCrewRole')
+    def _changecrewrole(self, entry):
+        self.role = entry['Role'] != 'Idle' and entry['Role'] or None
+
+    @handles('QuitACrew')
+    def _quitacrew(self, entry):
+        self.captain = None
+        self.role = None
+        self.body = None
+        self.system = None
+        self.station = None
+        self.coordinates = None
+
     def get_entry(self):
-        if not self.event_queue:
+        try:
+            line = self.event_queue.popleft()
+        except IndexError:
             return None
-        else:
-            entry = self.parse_entry(self.event_queue.pop(0))
-            if not self.live and entry['event'] not in [None, 'Fileheader']:
-                self.live = True
-                self.event_queue.append('{ "timestamp":"%s", "event":"StartUp" }' % strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()))
-            return entry
+        if self.backlogged and len(self.event_queue) <= self._QUEUE_MAX // 2:
+            self.backlogged = False
+            self.wakeup.set()	# Get the worker thread to read some more
+        entry = self.parse_entry(line)
+        if not self.live and entry['event'] not in [None, 'Fileheader']:
+            self.live = True
+            self.event_queue.append('{ "timestamp":"%s", "event":"StartUp" }' % strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()))
+        return entry
+
+    def get_entries(self, max_n=None, deadline=None):
+        # Generator for up to max_n queued entries, or as many as can be consumed before deadline.
+        # Entries are parsed as they're consumed, so monitor state reflects the entry most recently returned.
+        n = 0
+        while (max_n is None or n < max_n) and (deadline is None or time() < deadline):
+            entry = self.get_entry()
+            if not entry:
+                return
+            yield entry
+            n += 1
 
     def carrying_rares(self):
         for commodity in self.state['Cargo']:
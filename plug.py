@@ -3,15 +3,96 @@ Plugin hooks for EDMC - Ian Norton
 """
 import os
 import imp
+import json
+import multiprocessing
 import sys
+import threading
+import time
+import Queue
 
 from config import config
+from monitor import FrozenDict
 
 """
 Dictionary of loaded plugin modules.
 """
 PLUGINS = dict()
 
+"""
+Dictionary of background threads for plugins, if the user has chosen to run plugins in the background.
+"""
+PLUGIN_THREADS = dict()
+
+"""
+Journal event name -> list of (plugin name, journal_entry function, whether it takes state) for the plugins
+that want that event. Built by index_plugins().
+"""
+JOURNAL_INDEX = dict()
+JOURNAL_ALL = list()	# Plugins that want all events
+
+"""
+List of (plugin name, journal_entries function, set of wanted events or None for all) for the plugins that
+want journal entries in batches. Built by index_plugins().
+"""
+JOURNAL_BATCH = list()
+
+"""
+Dictionary of (plugin name, hook name) -> statistics for calls to plugins' event hooks. See _profile().
+"""
+PLUGIN_STATS = dict()
+
+MANIFEST = 'manifest.json'	# Optional file in a plugin's folder declaring its hooks
+
+PLUGIN_QUEUE = 100	# Max number of pending calls for a plugin running in the background
+PLUGIN_SLOW = 1		# Report a plugin running in the background as slow if a call takes longer than this [s]
+PLUGIN_TIMEOUT = 10	# Report a plugin running in the background as not responding if a call takes longer than this [s]
+
+
+class PluginThread(threading.Thread):
+    """
+    Calls a plugin's event hooks in the background so that a slow plugin can't hold up the main thread.
+    Pending calls are held in a bounded queue. Calls are dropped if the queue is full.
+    """
+
+    def __init__(self, plugname):
+        threading.Thread.__init__(self, name = 'Plugin %s' % plugname)
+        self.daemon = True
+        self.plugname = plugname
+        self.queue = Queue.Queue(PLUGIN_QUEUE)
+        self.started = None	# Time that the current call started, or None if idle
+        self.slow = 0		# Number of calls that took longer than PLUGIN_SLOW
+        self.dropped = 0	# Number of calls dropped because the queue was full
+
+    def call(self, hook, func, *args):
+        try:
+            self.queue.put_nowait((hook, func, args))
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            (hook, func, args) = self.queue.get()
+            self.started = time.time()
+            if _profile(self.plugname, hook, func, *args) > PLUGIN_SLOW:
+                self.slow += 1
+            self.started = None
+
+    def status(self):
+        """
+        :return: A description of any problem with this plugin, or None
+        """
+        started = self.started
+        if started and time.time() - started > PLUGIN_TIMEOUT:
+            return _('{PLUGIN} is not responding').format(PLUGIN=self.plugname)	# Status text for a plugin running in the background
+        elif self.dropped:
+            return _('{PLUGIN} is too slow - {COUNT} events dropped').format(PLUGIN=self.plugname, COUNT=self.dropped)	# Status text for a plugin running in the background
+        elif started and time.time() - started > PLUGIN_SLOW:
+            return _('{PLUGIN} is slow').format(PLUGIN=self.plugname)	# Status text for a plugin running in the background
+        elif self.slow:
+            return _('{PLUGIN} has been slow {COUNT} times').format(PLUGIN=self.plugname, COUNT=self.slow)	# Status text for a plugin running in the background
+        else:
+            return None
+
 
 def find_plugins():
     """
@@ -32,30 +113,233 @@ def find_plugins():
     return found, disabled
 
 
+def _read_manifest(loadfile):
+    """
+    Read the optional `manifest.json` file in a plugin's folder.
+    :param loadfile: path of the plugin's load.py
+    :return: The manifest as a dictionary, or None if the plugin doesn't have a manifest
+    """
+    manifestfile = os.path.join(os.path.dirname(loadfile), MANIFEST)
+    if not os.path.isfile(manifestfile):
+        return None
+    with open(manifestfile, "rb") as h:
+        return json.load(h)
+
+
 def load_plugins():
     """
-    Load all found plugins
+    Load all found plugins. Plugins whose manifest says that they have no UI are loaded in the background on
+    first use of one of their hooks instead.
     :return:
     """
     found, disabled = find_plugins()
-    imp.acquire_lock()
     for plugname in disabled:
         sys.stdout.write("plugin {} disabled\n".format(plugname))
 
     for plugname in found:
         try:
-            sys.stdout.write("loading plugin {}\n".format(plugname))
-            with open(found[plugname], "rb") as plugfile:
-                plugmod = imp.load_module(plugname, plugfile, found[plugname],
-                                          (".py", "r", imp.PY_SOURCE))
-                if "plugin_start" in dir(plugmod):
-                    newname = plugmod.plugin_start()
-                    PLUGINS[newname and unicode(newname) or plugname] = plugmod
+            manifest = _read_manifest(found[plugname])
+            if manifest and not manifest.get("ui", True):
+                newname = unicode(manifest.get("name") or plugname)
+                if manifest.get("process"):
+                    sys.stdout.write("starting plugin {} in its own process\n".format(plugname))
+                    PLUGINS[newname] = RemotePlugin(newname, plugname, found[plugname], manifest)
+                else:
+                    sys.stdout.write("deferring plugin {}\n".format(plugname))
+                    PLUGINS[newname] = LazyPlugin(newname, plugname, found[plugname], manifest)
+                PLUGIN_THREADS[newname] = PluginThread(newname)	# Lazy and remote plugins always run in the background
+                PLUGIN_THREADS[newname].start()
+            else:
+                sys.stdout.write("loading plugin {}\n".format(plugname))
+                (plugmod, newname) = _load_module(plugname, found[plugname])
+                if plugmod:
+                    PLUGINS[newname] = plugmod
+                    if config.getint('plugin_threads'):
+                        PLUGIN_THREADS[newname] = PluginThread(newname)
+                        PLUGIN_THREADS[newname].start()
 
         except Exception as plugerr:
             sys.stderr.write('%s: %s\n' % (plugname, plugerr))	# appears in %TMP%/EDMarketConnector.log in packaged Windows app
 
-    imp.release_lock()
+    index_plugins()
+
+
+def _load_module(plugname, loadfile, name=None):
+    """
+    Import a plugin and call its `plugin_start()`. The time taken is recorded in the plugin's statistics.
+    :param plugname: name of the plugin's folder
+    :param loadfile: path of the plugin's load.py
+    :param name: the name that the plugin is already known by, if any
+    :return: (module, name returned by plugin_start), or (None, None) if the plugin has no plugin_start
+    """
+    started = time.time()
+    imp.acquire_lock()
+    try:
+        with open(loadfile, "rb") as plugfile:
+            plugmod = imp.load_module(plugname, plugfile, loadfile,
+                                      (".py", "r", imp.PY_SOURCE))
+    finally:
+        imp.release_lock()
+    if "plugin_start" not in dir(plugmod):
+        return (None, None)
+    newname = plugmod.plugin_start()
+    newname = newname and unicode(newname) or plugname
+    elapsed = time.time() - started
+    _record(name or newname, 'plugin_start', elapsed)
+    sys.stdout.write("loaded plugin {} in {:.3f}s\n".format(plugname, elapsed))
+    return (plugmod, newname)
+
+
+class LazyPlugin:
+    """
+    Stands in for a plugin that declares its hooks in its manifest and has no UI, until first use of one of its
+    hooks. The plugin is then loaded on its background thread.
+    """
+
+    def __init__(self, name, plugname, loadfile, manifest):
+        self.name = name
+        self.plugname = plugname
+        self.loadfile = loadfile
+        self.module = None
+        self.failed = False
+        if manifest.get('journal_events') is not None:
+            self.journal_events = set(manifest['journal_events'])
+        hooks = manifest.get('hooks', [])
+        if 'journal_entry' in hooks:
+            self.journal_entry = lambda cmdr, system, station, entry, state: self._hook('journal_entry', cmdr, system, station, entry, state)
+        if 'journal_entries' in hooks:
+            self.journal_entries = lambda cmdr, system, station, entries, state: self._hook('journal_entries', cmdr, system, station, entries, state)
+        if 'cmdr_data' in hooks:
+            self.cmdr_data = lambda data: self._hook('cmdr_data', data)
+        if 'system_changed' in hooks:
+            self.system_changed = lambda timestamp, system, coordinates: self._hook('system_changed', timestamp, system, coordinates)
+        if 'prefs_changed' in hooks:
+            self.prefs_changed = lambda: self.module and self._hook('prefs_changed')	# Not worth loading the plugin for
+
+    def _hook(self, hook, *args):
+        if not self.module:
+            if self.failed:
+                return
+            self.failed = True	# Don't retry on every event
+            self.module = _load_module(self.plugname, self.loadfile, self.name)[0]
+            self.failed = not self.module
+        func = self.module and getattr(self.module, hook, None)
+        if func:
+            func(*args[:func.func_code.co_argcount])	# Drop optional arguments that the plugin doesn't take
+
+
+class RemotePlugin(LazyPlugin):
+    """
+    Stands in for a plugin that declares in its manifest that it has no UI and should run in its own process, so
+    that a CPU-heavy plugin doesn't compete with EDMC for the GIL. Hook calls are forwarded to the plugin host
+    process over a pipe, together with the parts of the state that have changed since the previous call, and
+    wait for the plugin to finish. Only ever called from the plugin's background thread.
+    """
+
+    STATE_HOOKS = ['journal_entry', 'journal_entries']	# Hooks whose last argument is the state
+
+    def __init__(self, name, plugname, loadfile, manifest):
+        LazyPlugin.__init__(self, name, plugname, loadfile, manifest)
+        if 'prefs_changed' in manifest.get('hooks', []):
+            self.prefs_changed = lambda: self._hook('prefs_changed')
+        self.state = None	# State most recently sent to the plugin host
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target = _host, args = (child, plugname, loadfile), name = 'Plugin %s' % name)
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def _hook(self, hook, *args):
+        if self.failed:
+            return
+        try:
+            if not self.module:
+                (elapsed, error) = self.conn.recv()	# Wait for plugin_start()
+                _record(self.name, 'plugin_start', elapsed, error is not None)
+                if error:
+                    self.failed = True
+                    raise Exception(error)
+                self.module = self.process
+            if hook in self.STATE_HOOKS:
+                state = args[-1]
+                args = args[:-1]
+                changes = dict([(k, v) for (k, v) in state.iteritems() if self.state is None or self.state.get(k) is not v])
+                self.state = state
+            else:
+                changes = None
+            self.conn.send((hook, args, changes, getattr(self.state, 'version', 0)))
+            error = self.conn.recv()
+        except (EOFError, IOError):
+            self.failed = True	# Plugin host has gone away
+            raise Exception('plugin host exited')
+        if error:
+            raise Exception(error)
+
+
+def _host(conn, plugname, loadfile):
+    """
+    Runs a plugin in the plugin host process. Receives (hook name, arguments, state changes, state version) from RemotePlugin
+    and replies with None, or with a description of the exception raised by the plugin.
+    """
+    started = time.time()
+    try:
+        with open(loadfile, "rb") as plugfile:
+            plugmod = imp.load_module(plugname, plugfile, loadfile,
+                                      (".py", "r", imp.PY_SOURCE))
+        if "plugin_start" in dir(plugmod):
+            plugmod.plugin_start()
+    except Exception as plugerr:
+        conn.send((time.time() - started, '%s: %s' % (plugname, plugerr)))
+        return
+    conn.send((time.time() - started, None))
+
+    state = FrozenDict()
+    while True:
+        try:
+            (hook, args, changes, version) = conn.recv()
+        except EOFError:
+            return	# EDMC has exited
+        if changes:
+            newstate = dict(state)
+            newstate.update(changes)
+            state = FrozenDict(newstate, None, version)
+        if hook in RemotePlugin.STATE_HOOKS:
+            args = args + (state,)
+        try:
+            func = getattr(plugmod, hook, None)
+            if func:
+                func(*args[:func.func_code.co_argcount])	# Drop optional arguments that the plugin doesn't take
+            conn.send(None)
+        except Exception as plugerr:
+            conn.send(unicode(plugerr))
+
+
+def index_plugins():
+    """
+    Build the index of which plugins want which journal events. Plugins can declare the events that they
+    want in a module-level `journal_events` set, otherwise they get all events.
+    Must be called again if PLUGINS is changed.
+    :return:
+    """
+    JOURNAL_INDEX.clear()
+    del JOURNAL_ALL[:]
+    del JOURNAL_BATCH[:]
+    subscribed = list()
+    for plugname in PLUGINS:
+        events = _get_plugin_func(plugname, "journal_events")
+        journal_entries = _get_plugin_func(plugname, "journal_entries")
+        if journal_entries:
+            JOURNAL_BATCH.append((plugname, journal_entries, events is not None and set(events) or None))
+        journal_entry = _get_plugin_func(plugname, "journal_entry")
+        if journal_entry:
+            target = (plugname, journal_entry, journal_entry.func_code.co_argcount != 4)
+            if events is None:
+                JOURNAL_ALL.append(target)
+            else:
+                subscribed.append((target, events))
+    for (target, events) in subscribed:
+        for event in events:
+            JOURNAL_INDEX.setdefault(event, list(JOURNAL_ALL)).append(target)
 
 
 def _get_plugin_func(plugname, funcname):
@@ -94,6 +378,96 @@ def get_plugin_prefs(plugname, parent):
     return None
 
 
+def _call(plugname, hook, func, *args):
+    """
+    Call a plugin's event hook, in the background if the user has chosen to run plugins in the background.
+    :param plugname: name of the plugin
+    :param hook: name of the hook
+    :param func: the plugin's hook function
+    :param args: arguments to pass
+    :return:
+    """
+    thread = PLUGIN_THREADS.get(plugname)
+    if thread:
+        thread.call(hook, func, *args)
+    else:
+        _profile(plugname, hook, func, *args)
+
+
+def _profile(plugname, hook, func, *args):
+    """
+    Call a plugin's event hook and record how long it took and whether it raised an exception.
+    Each (plugin, hook) pair is only ever called from one thread, so its statistics don't need locking.
+    :param plugname: name of the plugin
+    :param hook: name of the hook
+    :param func: the plugin's hook function
+    :param args: arguments to pass
+    :return: elapsed wall time [s]
+    """
+    started = time.time()
+    try:
+        func(*args)
+        failed = False
+    except Exception as plugerr:
+        failed = True
+        print plugerr
+    elapsed = time.time() - started
+    _record(plugname, hook, elapsed, failed)
+    return elapsed
+
+
+def _record(plugname, hook, elapsed, failed=False):
+    """
+    Add a call to a plugin's statistics.
+    """
+    stats = PLUGIN_STATS.get((plugname, hook))
+    if not stats:
+        stats = PLUGIN_STATS[(plugname, hook)] = { 'calls': 0, 'total': 0.0, 'max': 0.0, 'errors': 0 }
+    stats['calls'] += 1
+    stats['total'] += elapsed
+    if elapsed > stats['max']:
+        stats['max'] = elapsed
+    if failed:
+        stats['errors'] += 1
+
+
+def get_stats():
+    """
+    :return: A list of statistics for each plugin hook that has been called, slowest first. Each item is a
+    dictionary with 'plugin', 'hook', 'calls', 'total' and 'max' wall time [s], 'errors' and, for plugins
+    running in the background, 'dropped' calls.
+    """
+    stats = list()
+    for ((plugname, hook), value) in PLUGIN_STATS.items():
+        item = dict(value, plugin=plugname, hook=hook)
+        if plugname in PLUGIN_THREADS:
+            item['dropped'] = PLUGIN_THREADS[plugname].dropped
+        stats.append(item)
+    stats.sort(key = lambda x: (-x['total'], x['plugin'], x['hook']))
+    return stats
+
+
+def dump_stats(filename):
+    """
+    Write plugin hook statistics to a file in JSON format.
+    :param filename:
+    :return:
+    """
+    with open(filename, 'wt') as h:
+        h.write(json.dumps(get_stats(), ensure_ascii=False, indent=2, sort_keys=True, separators=(',', ': ')).encode('utf-8'))
+
+
+def get_status():
+    """
+    :return: A description of any problem with plugins running in the background, or None
+    """
+    for plugname in sorted(PLUGIN_THREADS):
+        status = PLUGIN_THREADS[plugname].status()
+        if status:
+            return status
+    return None
+
+
 def notify_prefs_changed():
     """
     Notify each plugin that the settings dialog has been closed.
@@ -101,11 +475,10 @@ def notify_prefs_changed():
     """
     for plugname in PLUGINS:
         prefs_changed = _get_plugin_func(plugname, "prefs_changed")
-        if prefs_changed:
-            try:
-                prefs_changed()
-            except Exception as plugerr:
-                print plugerr
+        if prefs_changed and isinstance(PLUGINS[plugname], RemotePlugin):
+            _call(plugname, 'prefs_changed', prefs_changed)	# Mustn't use the pipe from the main thread
+        elif prefs_changed:
+            _profile(plugname, 'prefs_changed', prefs_changed)
 
 
 def notify_journal_entry(cmdr, system, station, entry, state):
@@ -115,20 +488,34 @@ def notify_journal_entry(cmdr, system, station, entry, state):
     :param system: The current system, or None if not yet known
     :param station: The current station, or None if not docked or not yet known
     :param entry: The journal entry as a dictionary
-    :param state: A dictionary containing info about the Cmdr, current ship and cargo
+    :param state: A read-only dictionary containing info about the Cmdr, current ship and cargo, as returned by
+    monitor.get_state(). Shared by all plugins, including those running in the background.
     :return:
     """
-    for plugname in PLUGINS:
-        journal_entry = _get_plugin_func(plugname, "journal_entry")
-        if journal_entry:
-            try:
-                # Pass a copy of the journal entry in case the callee modifies it
-                if journal_entry.func_code.co_argcount == 4:
-                    journal_entry(cmdr, system, station, dict(entry))
-                else:
-                    journal_entry(cmdr, system, station, dict(entry), dict(state))
-            except Exception as plugerr:
-                print plugerr
+    for (plugname, journal_entry, wants_state) in JOURNAL_INDEX.get(entry['event'], JOURNAL_ALL):
+        # Pass a copy of the journal entry in case the callee modifies it
+        if not wants_state:
+            _call(plugname, 'journal_entry', journal_entry, cmdr, system, station, dict(entry))
+        else:
+            _call(plugname, 'journal_entry', journal_entry, cmdr, system, station, dict(entry), state)
+
+
+def notify_journal_entries(cmdr, system, station, entries, state):
+    """
+    Send a batch of journal entries to each plugin that wants them all at once.
+    :param cmdr: The Cmdr name, or None if not yet known
+    :param system: The current system, or None if not yet known
+    :param station: The current station, or None if not docked or not yet known
+    :param entries: A list of journal entries as dictionaries, in order
+    :param state: A read-only dictionary containing info about the Cmdr, current ship and cargo after the last
+    entry, as returned by monitor.get_state()
+    :return:
+    """
+    for (plugname, journal_entries, events) in JOURNAL_BATCH:
+        # Pass copies of the journal entries in case the callee modifies them
+        wanted = [dict(entry) for entry in entries if events is None or entry['event'] in events]
+        if wanted:
+            _call(plugname, 'journal_entries', journal_entries, cmdr, system, station, wanted, state)
 
 
 def notify_system_changed(timestamp, system, coordinates):
@@ -143,13 +530,10 @@ def notify_system_changed(timestamp, system, coordinates):
     for plugname in PLUGINS:
         system_changed = _get_plugin_func(plugname, "system_changed")
         if system_changed:
-            try:
-                if system_changed.func_code.co_argcount == 2:
-                    system_changed(timestamp, system)
-                else:
-                    system_changed(timestamp, system, coordinates)
-            except Exception as plugerr:
-                print plugerr
+            if system_changed.func_code.co_argcount == 2:
+                _call(plugname, 'system_changed', system_changed, timestamp, system)
+            else:
+                _call(plugname, 'system_changed', system_changed, timestamp, system, coordinates)
 
 
 def notify_newdata(data):
@@ -161,7 +545,4 @@ def notify_newdata(data):
     for plugname in PLUGINS:
         cmdr_data = _get_plugin_func(plugname, "cmdr_data")
         if cmdr_data:
-            try:
-                cmdr_data(data)
-            except Exception as plugerr:
-                print plugerr
+            _call(plugname, 'cmdr_data', cmdr_data, data)
@@ -43,6 +43,7 @@ def plugin_app(parent):
     :return:
     """
     plugin_app.status = tk.Label(parent, text="---")
+    plugin_app.status.bind("<<AboutUpdate>>", lambda event: plugin_app.status.config(text=plugin_app.text))	# on the main thread
     return plugin_app.status
 
 
@@ -71,7 +72,8 @@ def cmdr_data(data):
     :return:
     """
     cmdr_data.last = data
-    plugin_app.status['text'] = "Got new data ({} chars)".format(len(str(data)))
+    plugin_app.text = "Got new data ({} chars)".format(len(str(data)))
+    plugin_app.status.event_generate("<<AboutUpdate>>", when="tail")	# May be called on a background thread
     sys.stderr.write("Got new data ({} chars)\n".format(len(str(data))))
 
 cmdr_data.last = None
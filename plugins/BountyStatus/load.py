@@ -25,6 +25,11 @@ bonds = defaultdict(int)
 
 treeview = None
 viewroot = ""
+shown = {}  # Copy of the data to show, for the main thread
+changed = None  # Data to show after this batch of entries
+
+# Journal events that we're interested in
+journal_events = set([u"Bounty", u"FactionKillBond", u"RedeemVoucher", u"SupercruiseExit"])
 
 # Mahon Mission Log URL
 reporturl = """https://docs.google.com/forms/d/e/1FAIpQLSdpZSlFXwmNFoK0O6o7pY24xpM9Uhx-G5WAJ22rzPlfqk_pMw/viewform"""
@@ -52,6 +57,12 @@ def update_treeview(source):
         child=treeview.insert(viewroot, "end", text=faction, 
             values=[stringFromNumber(amount)])
 
+# Hooks may be called on a background thread, so ask the main thread to update the view
+def show(source):
+    global shown
+    shown = dict(source)
+    treeview.event_generate("<<BountyStatusUpdate>>", when="tail")
+
 # Functions called by EDMC
 def plugin_start():
     pass
@@ -62,13 +73,27 @@ def plugin_app(parent):
     treeview.heading("#0", text="Faction")
     treeview.heading(0, text="Credits")
     treeview.column(0, anchor=tk.E)     # right align numbers
+    treeview.bind("<<BountyStatusUpdate>>", lambda event: update_treeview(shown))
     
     #bounties["foo"] = 12345678
     #update_treeview(bounties)
     #treeview.set_children("", "Recent bounties", "Recent combat bonds")
     return treeview
 
-def journal_entry(cmdr, system, station, entry, state):
+def journal_entry(cmdr, system, station, entry):
+    # Called for each entry with the cmdr and system at the time, for the reports
+    global changed
+    changed = handle_entry(cmdr, system, entry) or changed
+
+def journal_entries(cmdr, system, station, entries, state):
+    # Called after all the entries seen at once, so only update the view once
+    global changed
+    if changed is not None:
+        show(changed)
+        changed = None
+
+# Returns the data to show if it has changed
+def handle_entry(cmdr, system, entry):
     global victims, bounties, bonds
     # Relevant events:
     # SupercruiseExit should mark when we enter a CZ, pirate zone etc
@@ -90,10 +115,10 @@ def journal_entry(cmdr, system, station, entry, state):
             rewards = [entry]
         for subentry in rewards:
             bounties[subentry['Faction']] += subentry['Reward']
-        update_treeview(bounties)
+        return bounties
     elif entry['event']==u"FactionKillBond":
         bonds[entry['AwardingFaction']] += entry['Reward']
-        update_treeview(bonds)
+        return bonds
     elif entry['event'] == u"RedeemVoucher":
         # BGS report portion
         if entry['Type'] == u'bounty':
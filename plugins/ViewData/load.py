@@ -33,7 +33,7 @@ def journal_entry(cmdr, system, station, entry, state):
     #data['entry'] = entry
     data['entries'].append(entry)
     data['state'] = state
-    update_data(data)
+    show()
     # Example entry of interest: PowerplayCollect
     # Documentation at https://forums.frontier.co.uk/showthread.php/275151-Commanders-log-manual-and-data-sample
     
@@ -56,7 +56,7 @@ def cmdr_data(data_):
     # It has an id but it doesn't match EDDB. 
     # Combine with 'lastSystem' name for lookups. 
     data['data'] = data_
-    update_data(data)
+    show()
 
 # Functions to handle our UI
 
@@ -90,12 +90,18 @@ def show_data():
     w.title("EDMC Data")
     #text = tk.Text(w)
     view = ttk.Treeview(w, columns=1)
+    view.bind("<<ViewDataUpdate>>", lambda event: update_data(data))
     update_data(data)
     sb = ttk.Scrollbar(w, command=view.yview)
     view.configure(yscrollcommand=sb.set)
     sb.pack(fill=tk.Y, expand=0, side=tk.RIGHT)
     view.pack(fill=tk.BOTH, expand=1)
 
+# Hooks may be called on a background thread, so ask the main thread to update the view
+def show():
+    if view:
+        view.event_generate("<<ViewDataUpdate>>", when="tail")
+
 def update_data(data):
     global view
     if view:
@@ -3,6 +3,7 @@
 import os
 from os.path import dirname, expanduser, expandvars, exists, isdir, join, normpath
 from sys import platform
+from time import localtime, strftime
 import webbrowser
 
 import Tkinter as tk
@@ -13,6 +14,7 @@ import myNotebook as nb
 
 from config import applongname, config
 import eddn
+import edsm
 from hotkey import hotkeymgr
 from l10n import Translations
 from monitor import monitor
@@ -58,6 +60,8 @@ elif platform=='win32':
 
 class PreferencesDialog(tk.Toplevel):
 
+    _REFRESH = 1000	# EDDN statistics refresh interval [ms]
+
     def __init__(self, parent, callback):
         tk.Toplevel.__init__(self, parent)
 
@@ -164,6 +168,7 @@ class PreferencesDialog(tk.Toplevel):
 
 
         eddnframe = nb.Frame(notebook)
+        eddnframe.columnconfigure(0, weight=1)
 
         HyperlinkLabel(eddnframe, text='Elite Dangerous Data Network', background=nb.Label().cget('background'), url='https://github.com/jamesremuscat/EDDN/wiki', underline=True).grid(padx=PADX, sticky=tk.W)	# Don't translate
         self.eddn_station= tk.IntVar(value = (output & config.OUT_MKT_EDDN) and 1)
@@ -177,6 +182,30 @@ class PreferencesDialog(tk.Toplevel):
         self.eddn_delay= tk.IntVar(value = (output & config.OUT_SYS_DELAY) and 1)
         self.eddn_delay_button = nb.Checkbutton(eddnframe, text=_('Delay sending until docked'), variable=self.eddn_delay)	# Output setting under 'Send system and scan data to the Elite Dangerous Data Network' new in E:D 2.2
         self.eddn_delay_button.grid(padx=BUTTONX, sticky=tk.W)
+        self.eddn_gzip = tk.IntVar(value = not config.getint('eddn_nogzip'))
+        nb.Checkbutton(eddnframe, text=_('Compress data sent to EDDN'), variable=self.eddn_gzip).grid(padx=BUTTONX, pady=(5,0), sticky=tk.W)	# Output setting. Turn off if a proxy rejects compressed data.
+        nb.Label(eddnframe, text=_('Other EDDN targets (takes effect on restart)')+':').grid(padx=PADX, pady=(5,0), sticky=tk.W)	# EDDN setting
+        self.eddn_targets = nb.Entry(eddnframe)
+        self.eddn_targets.insert(0, ', '.join((config.get('eddn_endpoints') or [])[1:]))	# Each is 'URL [senders [max retry interval]]'
+        self.eddn_targets.grid(padx=PADX, pady=PADY, sticky=tk.EW)
+
+        self.eddn_table = None
+        if eddn.targets:
+            ttk.Separator(eddnframe, orient=tk.HORIZONTAL).grid(padx=PADX, pady=PADY*8, sticky=tk.EW)
+            self.eddn_table = ttk.Treeview(eddnframe, columns=('sent', 'pending', 'retries', 'rate', 'lag', 'status'), height=len(eddn.targets), selectmode=tk.BROWSE)
+            self.eddn_table.heading('#0', text=_('Target'))		# EDDN statistics column heading
+            self.eddn_table.heading('sent', text=_('Sent'))		# EDDN statistics column heading
+            self.eddn_table.heading('pending', text=_('Waiting'))	# EDDN statistics column heading - messages not yet sent
+            self.eddn_table.heading('retries', text=_('Retries'))	# EDDN statistics column heading
+            self.eddn_table.heading('rate', text=_('Rate'))		# EDDN statistics column heading - messages sent per minute
+            self.eddn_table.heading('lag', text=_('Lag'))		# EDDN statistics column heading - age of oldest unsent message [s]
+            self.eddn_table.heading('status', text=_('Status'))	# EDDN statistics column heading
+            self.eddn_table.column('#0', width=150)
+            for column in ['sent', 'pending', 'retries', 'rate', 'lag']:
+                self.eddn_table.column(column, width=55, anchor=tk.E)
+            self.eddn_table.column('status', width=120)
+            self.eddn_table.grid(padx=PADX, sticky=tk.EW)
+            self.eddnrefresh()
 
         notebook.add(eddnframe, text='EDDN')		# Not translated
 
@@ -208,6 +237,9 @@ class PreferencesDialog(tk.Toplevel):
         self.edsm_apikey = nb.Entry(edsmframe)
         self.edsm_apikey.grid(row=12, column=1, padx=PADX, pady=PADY, sticky=tk.EW)
 
+        ttk.Separator(edsmframe, orient=tk.HORIZONTAL).grid(columnspan=2, padx=PADX, pady=PADY*8, sticky=tk.EW)
+        nb.Label(edsmframe, text=_('Materials and ship updates: {SENT} sent, {SUPPRESSED} combined or unchanged and not sent').format(SENT=edsm.counters['sent'], SUPPRESSED=edsm.counters['suppressed'])).grid(columnspan=2, padx=PADX, sticky=tk.W)	# EDSM statistics
+
         notebook.add(edsmframe, text='EDSM')		# Not translated
 
         # build plugin prefs tabs
@@ -234,6 +266,9 @@ class PreferencesDialog(tk.Toplevel):
             if config.default_journal_dir:
                 nb.Button(configframe, text=_('Default'), command=self.logdir_reset, state = config.get('journaldir') and tk.NORMAL or tk.DISABLED).grid(column=2, padx=PADX, pady=(5,0), sticky=tk.EW)	# Appearance theme and language setting
 
+        self.journaldb = tk.IntVar(value = config.getint('journaldb'))
+        nb.Checkbutton(configframe, text=_('Keep an index of past journal entries (takes effect on restart)'), variable=self.journaldb).grid(columnspan=3, padx=BUTTONX, pady=(5,0), sticky=tk.W)	# Journal setting
+
         if platform == 'win32':
             ttk.Separator(configframe, orient=tk.HORIZONTAL).grid(columnspan=3, padx=PADX, pady=PADY*8, sticky=tk.EW)
 
@@ -327,6 +362,11 @@ class PreferencesDialog(tk.Toplevel):
         nb.Label(plugsframe, text=_("Tip: You can disable a plugin by{CR}adding '{EXT}' to it's folder name").format(EXT='.disabled')).grid(	# Help text in settings
             columnspan=2, padx=PADX, pady=10, sticky=tk.NSEW)
 
+        self.plugin_threads = tk.IntVar(value = config.getint('plugin_threads'))
+        nb.Checkbutton(plugsframe, text=_('Run plugins in the background (takes effect on restart)'), variable=self.plugin_threads).grid(columnspan=2, padx=BUTTONX, sticky=tk.W)	# Plugin setting
+        nb.Button(plugsframe, text=_('Diagnostics'),	# Button that shows plugin timings
+                  command=lambda: PluginStatsDialog(self)).grid(columnspan=2, padx=PADX, pady=PADY, sticky=tk.W)
+
         if len(plugnames):
             ttk.Separator(plugsframe, orient=tk.HORIZONTAL).grid(columnspan=3, padx=PADX, pady=PADY * 8, sticky=tk.EW)
             nb.Label(plugsframe, text=_('Enabled Plugins')+':').grid(padx=PADX, sticky=tk.W)	# List of plugins in settings
@@ -594,6 +634,7 @@ class PreferencesDialog(tk.Toplevel):
             config.set('hotkey_always', int(not self.hotkey_only.get()))
             config.set('hotkey_mute', int(not self.hotkey_play.get()))
         config.set('shipyard', self.shipyard.get())
+        config.set('journaldb', self.journaldb.get())
 
         lang_codes = { v: k for k, v in self.languages.iteritems() }	# Codes by name
         config.set('language', lang_codes.get(self.lang.get()) or '')
@@ -605,7 +646,15 @@ class PreferencesDialog(tk.Toplevel):
         config.set('dark_highlight', self.theme_colors[1])
         theme.apply(self.parent)
 
+        config.set('eddn_nogzip', int(not self.eddn_gzip.get()))
+        primary = (config.get('eddn_endpoints') or [eddn.EDDN.UPLOAD])[0]
+        targets = [x.strip() for x in self.eddn_targets.get().split(',') if x.strip()]
+        if targets or primary != eddn.EDDN.UPLOAD:
+            config.set('eddn_endpoints', [primary] + targets)
+        else:
+            config.delete('eddn_endpoints')
         config.set('anonymous', self.out_anon.get())
+        config.set('plugin_threads', self.plugin_threads.get())
 
         plug.notify_prefs_changed()
 
@@ -613,7 +662,23 @@ class PreferencesDialog(tk.Toplevel):
         if self.callback:
             self.callback()
 
+    def eddnrefresh(self):
+        self.eddn_table.delete(*self.eddn_table.get_children())
+        for endpoint in eddn.targets:
+            stats = endpoint.stats()
+            self.eddn_table.insert('', tk.END, text=stats['url'], values=(
+                stats['messages'],
+                stats['pending'],
+                stats['retries'],
+                '%.1f' % (stats['rate'] * 60),
+                '%.0f' % stats['lag'],
+                stats['error'] or '',
+            ))
+        self.eddn_after = self.after(self._REFRESH, self.eddnrefresh)
+
     def _destroy(self):
+        if self.eddn_table:
+            self.after_cancel(self.eddn_after)
         self.parent.wm_attributes('-topmost', config.getint('always_ontop') and 1 or 0)
         self.destroy()
 
@@ -713,6 +778,92 @@ class AuthenticationDialog(tk.Toplevel):
         self.destroy()
         if self.callback: self.callback(None)
 
+
+# Show how long each plugin's event hooks are taking
+class PluginStatsDialog(tk.Toplevel):
+
+    _REFRESH = 1000	# [ms]
+
+    def __init__(self, parent):
+        tk.Toplevel.__init__(self, parent)
+
+        self.parent = parent
+        self.title(_('Plugin Diagnostics'))	# Plugin diagnostics dialog title
+
+        if parent.winfo_viewable():
+            self.transient(parent)
+
+        # position over parent
+        if platform!='darwin' or parent.winfo_rooty()>0:	# http://core.tcl.tk/tk/tktview/c84f660833546b1b84e7
+            self.geometry("+%d+%d" % (parent.winfo_rootx(), parent.winfo_rooty()))
+
+        # remove decoration
+        self.resizable(tk.FALSE, tk.FALSE)
+        if platform=='win32':
+            self.attributes('-toolwindow', tk.TRUE)
+        elif platform=='darwin':
+            # http://wiki.tcl.tk/13428
+            parent.call('tk::unsupported::MacWindowStyle', 'style', self, 'utility')
+
+        frame = ttk.Frame(self)
+        frame.grid(sticky=tk.NSEW)
+
+        self.table = ttk.Treeview(frame, columns=('hook', 'calls', 'total', 'max', 'errors', 'dropped'), height=12, selectmode=tk.BROWSE)
+        self.table.heading('#0', text=_('Plugin'))		# Plugin diagnostics column heading
+        self.table.heading('hook', text=_('Event'))		# Plugin diagnostics column heading
+        self.table.heading('calls', text=_('Calls'))	# Plugin diagnostics column heading
+        self.table.heading('total', text=_('Total'))	# Plugin diagnostics column heading - total time [s]
+        self.table.heading('max', text=_('Max'))		# Plugin diagnostics column heading - longest call [s]
+        self.table.heading('errors', text=_('Errors'))	# Plugin diagnostics column heading
+        self.table.heading('dropped', text=_('Dropped'))	# Plugin diagnostics column heading - calls dropped
+        self.table.column('#0', width=150)
+        self.table.column('hook', width=110)
+        for column in ['calls', 'total', 'max', 'errors', 'dropped']:
+            self.table.column(column, width=70, anchor=tk.E)
+        self.table.grid(padx=10, pady=10, sticky=tk.NSEW)
+
+        buttonframe = ttk.Frame(frame)
+        buttonframe.grid(padx=10, pady=(0,10), sticky=tk.NSEW)
+        buttonframe.columnconfigure(0, weight=1)
+        ttk.Label(buttonframe).grid(row=0, column=0)	# spacer
+        ttk.Button(buttonframe, text=_('Save Raw Data...'), command=self.save).grid(row=0, column=1, padx=(0,5), sticky=tk.E)
+        ttk.Button(buttonframe, text=_('OK'), command=self._destroy).grid(row=0, column=2, sticky=tk.E)
+
+        self.protocol("WM_DELETE_WINDOW", self._destroy)
+        self.refresh()
+
+        # wait for window to appear on screen before calling grab_set
+        self.wait_visibility()
+        self.grab_set()
+
+    def refresh(self):
+        self.table.delete(*self.table.get_children())
+        for stats in plug.get_stats():
+            self.table.insert('', tk.END, text=stats['plugin'], values=(
+                stats['hook'],
+                stats['calls'],
+                '%.3f' % stats['total'],
+                '%.3f' % stats['max'],
+                stats['errors'],
+                stats.get('dropped', ''),
+            ))
+        self.after_id = self.after(self._REFRESH, self.refresh)
+
+    def save(self):
+        import tkFileDialog
+        f = tkFileDialog.asksaveasfilename(parent = self,
+                                           defaultextension = platform=='darwin' and '.json' or '',
+                                           filetypes = [('JSON', '.json'), ('All Files', '*')],
+                                           initialdir = config.get('outdir'),
+                                           initialfile = 'plugins.%s.json' % strftime('%Y-%m-%dT%H.%M.%S', localtime()))
+        if f:
+            plug.dump_stats(f)
+
+    def _destroy(self):
+        self.after_cancel(self.after_id)
+        self.destroy()
+        self.parent.grab_set()	# Return control to the settings dialog
+
 # migration from <= 2.25. Assumes current Cmdr corresponds to the saved credentials
 def migrate(current_cmdr):
     if current_cmdr and not config.get('cmdrs') and config.get('username') and config.get('password'):